@@ -8,13 +8,13 @@ import matplotlib
 import glob
 
 def openData(filename):
-    with open(filename) as csvFile:
-        reader = csv.reader(csvFile)
-        keys = next(reader)
+    df = pd.read_csv(filename)
     dictionary = dict()
-    for i in keys:
-        df = pd.read_csv(filename)
-        dictionary[i]=np.array(df[i])
+    for i in df.columns:
+        if i.startswith('MAG') or i.startswith('CMAG'):
+            dictionary[i] = np.array(pd.to_numeric(df[i],errors='coerce')) # rows written before the numeric output used '---' for other filters
+        else:
+            dictionary[i] = np.array(df[i])
     return dictionary
 
 sources = openData('sources.csv')
@@ -55,8 +55,8 @@ Vmags_err = []
 colors_err = []
 
 for starid in unqiue_stars:
-    Vmag = [float(sources['MAG_V'][i]) for i in indices if sources['id'][i]==starid and not sources['MAG_V'][i]=='---' and not sources['MAG_V'][i]=='nan']
-    Bmag = [float(sources['MAG_B'][i]) for i in indices if sources['id'][i]==starid and not sources['MAG_B'][i]=='---' and not sources['MAG_B'][i]=='nan']
+    Vmag = [sources['MAG_V'][i] for i in indices if sources['id'][i]==starid and not np.isnan(sources['MAG_V'][i])]
+    Bmag = [sources['MAG_B'][i] for i in indices if sources['id'][i]==starid and not np.isnan(sources['MAG_B'][i])]
     # Bmag = [sources['MAG_B'][i] if not sources['MAG_B'][i]=='---' and not sources['MAG_B'][i]=='nan']
 
     # print(Vmag,Bmag)
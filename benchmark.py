@@ -0,0 +1,195 @@
+# benchmarks for the pipeline, run from the same directory as pipeline.py
+# usage: python benchmark.py <test> [arguments], where <test> is one of the functions below, e.g.
+#   python benchmark.py src 20180729
+#   python benchmark.py tiles ReducedImages/20180729/image_c.fits 2 2
+#   python benchmark.py coarse ReducedImages/20180729/image_c.fits 2
+#   python benchmark.py reduce_memory ArchSky/20180729/image.fits 256
+#   python benchmark.py storage ReducedImages/20180729/image_c.fits
+
+import observatory as obs
+import numpy as np
+import sys
+import os
+from time import time
+
+
+def src(date):
+    '''
+    Compares the .SRC source lists Image Link saved for a night against sep detection on the calibrated images:
+    time to get each source list, and how well the two lists agree (matched within 3 pixels, median offset).
+    '''
+    f = obs.Field()
+    f.cache_products = False # time the detection itself, not the cached result
+    f.uncalibrated_path = 'ArchSky/'+date+'/'
+    f.calibrated_path = 'ReducedImages/'+date+'/'
+    filenames = [n for n in os.listdir(f.uncalibrated_path) if n.endswith('.fits') or n.endswith('.fit')]
+
+    print('%-50s %8s %8s %8s %8s %10s %10s' % ('image','N_sep','N_src','t_sep','t_src','matched','offset'))
+    for filename in filenames:
+        if not os.path.exists(f.uncalibrated_path+os.path.splitext(filename)[0]+'.SRC'):
+            continue
+        if not os.path.exists(f.calibrated_path+filename.replace('.fits','_c.fits')):
+            continue
+        f.openFits(filename,calibrated=True,inPipeline=True)
+
+        t0 = time()
+        detected = f.Source()
+        t_sep = time()-t0
+        t0 = time()
+        listed = f.readSRC()
+        t_src = time()-t0
+        if listed is None:
+            continue
+
+        # nearest .SRC position for every sep detection
+        dx = detected['x'][:,None]-listed['x'][None,:]
+        dy = detected['y'][:,None]-listed['y'][None,:]
+        dist = np.sqrt(dx*dx+dy*dy)
+        nearest = np.argmin(dist,axis=1)
+        matched = dist[np.arange(len(detected)),nearest]<3
+        offset = (np.median(dx[np.arange(len(detected)),nearest][matched]),np.median(dy[np.arange(len(detected)),nearest][matched]))
+
+        print('%-50s %8s %8s %8.3f %8.4f %9.1f%% %10s' % (filename[:50],len(detected),len(listed),t_sep,t_src,
+              100.0*np.sum(matched)/max(len(detected),1),'%.2f,%.2f' % offset))
+
+
+def tiles(filename,nx=2,ny=2,processes=False):
+    '''
+    Times single-tile source detection on a calibrated image against tiled detection with 1, 2, 4, ... workers
+    (up to the number of cores), and checks the tiled catalog matches the single-tile one.
+    '''
+    import multiprocessing
+    f = obs.Field()
+    f.cache_products = False # time the detection itself, not the cached result
+    f.openFits(filename,calibrated=False,inPipeline=False)
+    minarea = 120/f.hdr['XBINNING']/f.hdr['YBINNING']
+
+    t0 = time()
+    f.tiles = (1,1)
+    single = f.Source()
+    t_single = time()-t0
+    print('single tile: %s objects in %.3fs' % (len(single),t_single))
+
+    workers = 1
+    while workers<=multiprocessing.cpu_count():
+        t0 = time()
+        tiled = obs.extractTiled(f.img,4,minarea,(int(nx),int(ny)),256/f.hdr['XBINNING'],workers,processes=processes in [True,'True'])
+        t_tiled = time()-t0
+        dist = np.sqrt((single['x'][:,None]-tiled['x'][None,:])**2+(single['y'][:,None]-tiled['y'][None,:])**2)
+        matched = np.sum(np.min(dist,axis=1)<0.01) if len(tiled) else 0
+        print('%sx%s tiles, %s workers: %s objects (%s matched) in %.3fs, speedup %.2f' % (nx,ny,workers,len(tiled),matched,t_tiled,t_single/t_tiled))
+        workers *= 2
+
+
+def coarse(filename,factor=2):
+    '''
+    Times full resolution source detection on a calibrated image against coarse-to-fine detection on a
+    factor x factor binned copy, and prints the completeness report for the binned detection.
+    '''
+    f = obs.Field()
+    f.cache_products = False # time the detection itself, not the cached result
+    f.openFits(filename,calibrated=False,inPipeline=False)
+
+    t0 = time()
+    full = f.Source()
+    t_full = time()-t0
+
+    f.detect_binning = int(factor)
+    t0 = time()
+    binned = f.Source()
+    t_binned = time()-t0
+    print('full resolution: %s objects in %.3fs, %sx%s binned: %s objects in %.3fs, speedup %.2f' %
+          (len(full),t_full,factor,factor,len(binned),t_binned,t_full/t_binned))
+    f.Completeness()
+
+
+def resident():
+    '''
+    Resident memory of this process in bytes (Linux).
+    '''
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1])*os.sysconf('SC_PAGE_SIZE')
+
+
+def _reduce(filename,mode):
+    '''
+    Calibrates one uncalibrated image and prints the growth in peak RSS and the time, run in its own process by reduce_memory().
+    mode is 'float64' for the original expressions with the masters read as float64, otherwise the rows per chunk for the
+    in-place float32 kernel (0 for the whole frame at once).
+    '''
+    import resource
+    f = obs.Field()
+    f.openFits(filename,calibrated=False,inPipeline=False)
+    f.path_to_masters = 'MasterCal/binning%s/' % f.hdr['XBINNING']
+    masters = (f.masterFilename('bias',f.hdr),f.masterFilename('dark',f.hdr),f.masterFilename('flat',f.hdr))
+    bias_h,bias = obs.loadMaster(masters[0])
+    dark_h,dark = obs.loadMaster(masters[1])
+    flat_h,flat = obs.loadMaster(masters[2])
+    if mode=='float64':
+        bias,dark,flat = bias.astype(float),dark.astype(float),flat.astype(float)
+    else:
+        offset,inverse_flat = obs.calibrationPlan(masters,f.hdr['EXPTIME'],bias,flat,dark=dark,dxptime=dark_h['EXPTIME'])
+
+    before = resident()
+    t0 = time()
+    if mode=='float64':
+        bias_corrected_image = f.img - bias
+        dark_corrected_image = bias_corrected_image - (f.hdr['EXPTIME']/dark_h['EXPTIME']) * dark
+        final_image = dark_corrected_image / flat
+    else:
+        final_image = obs.calibrateFrame(f.img,offset,inverse_flat,rows=int(mode))
+    t = time()-t0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024 # ru_maxrss is in kB on Linux
+    print('%s %s %s' % (max(peak-before,0),t,f.img.nbytes))
+
+
+def reduce_memory(filename,rows=256):
+    '''
+    Peak memory used to calibrate one image with the original float64 expressions and with the in-place float32 kernel
+    (whole frame and in chunks of rows), each in a separate process so one case's peak can't hide another's.
+    '''
+    import subprocess
+    print('%-24s %12s %10s %10s' % ('method','peak MB','frames','time'))
+    for mode,name in [('float64','float64 expressions'),('0','float32 in place'),(str(rows),'float32 %s rows' % rows)]:
+        out = subprocess.check_output([sys.executable,__file__,'_reduce',filename,mode]).split()
+        peak,t,frame = int(out[-3]),float(out[-2]),int(out[-1])
+        print('%-24s %12.1f %10.2f %10.3f' % (name,peak/1e6,float(peak)/frame,t))
+
+
+def storage(filename,repeats=3):
+    '''
+    Writes a calibrated image in each storage mode (float64 as before, float32, and tile compressed with a few
+    quantize levels) and prints the file size, write and read throughput (MB/s of float32 image) and the largest
+    change to a pixel relative to the noise in the image.
+    '''
+    import tempfile
+    import shutil
+    hdr,img = obs.readFits(filename)
+    noise = 1.4826*np.median(np.abs(img-np.median(img))) # MAD estimate of the noise
+    megabytes = img.nbytes/1e6
+    path = tempfile.mkdtemp()
+    print('%-16s %6s %10s %8s %10s %10s %12s' % ('mode','q','size MB','ratio','write MB/s','read MB/s','max err/rms'))
+    try:
+        for mode,q in [('float64',None),(None,None),('GZIP_2',0),('RICE_1',4),('RICE_1',16),('RICE_1',64),('GZIP_2',16)]:
+            name = os.path.join(path,'image.fits')
+            obs.image_compression,obs.quantize_level = (None,16.0) if mode=='float64' else (mode,q)
+            t0 = time()
+            for i in range(int(repeats)):
+                if mode=='float64':
+                    obs.fits.writeto(name,img.astype(float),hdr,overwrite=True)
+                else:
+                    obs.writeImage(name,img,hdr,overwrite=True)
+            t_write = (time()-t0)/int(repeats)
+            t0 = time()
+            for i in range(int(repeats)):
+                data = obs.readFits(name)[1]
+            t_read = (time()-t0)/int(repeats)
+            size = os.path.getsize(name)/1e6
+            print('%-16s %6s %10.2f %8.2f %10.1f %10.1f %12.4f' % (mode or 'float32',q if q is not None else '',size,
+                  size/megabytes,megabytes/t_write,megabytes/t_read,np.max(np.abs(data-img))/noise))
+    finally:
+        shutil.rmtree(path)
+
+
+if __name__=='__main__':
+    globals()[sys.argv[1]](*sys.argv[2:])
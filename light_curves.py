@@ -78,13 +78,13 @@ def init():
         sleep(0.5)
     
 def openData(filename):
-    with open(filename) as csvFile:
-        reader = csv.reader(csvFile)
-        keys = next(reader)
+    df = pd.read_csv(filename)
     dictionary = dict()
-    for i in keys:
-        df = pd.read_csv(filename)
-        dictionary[i]=np.array(df[i])
+    for i in df.columns:
+        if i.startswith('MAG') or i.startswith('CMAG'):
+            dictionary[i] = np.array(pd.to_numeric(df[i],errors='coerce')) # rows written before the numeric output used '---' for other filters
+        else:
+            dictionary[i] = np.array(df[i])
     return dictionary
 
 # def find_comparison_stars(data,RA,DEC,magnitude,imagename):
@@ -238,31 +238,9 @@ while True:
             end = np.amax(datetimes)
             printright('Choice Registered: All time data',clear=True,delay=True)
 
-        mags,error,time = [],[],[]
-
-
-
-        for x in indices:
-            mags.append(sources['MAG_'+filt][x])
-            error.append(sources['MAG_err'][x])
-            time.append(datetime.strptime(sources['DATETIME'][x], '%Y-%m-%d %H:%M:%S.%f'))
-
-        try:
-            mags = [float(mags[x]) for x in range(len(mags)) if not math.isnan(float(mags[x]))]
-        except ValueError:
-            print('\tNo %s magnitude data found' % filt)
-            sleep(0.5)
-            print('\tReturning to Star Lookup')
-            sleep(2.5)
-            print("\033c")
-            sleep(0.5)
-            header()
-            sleep(0.5)
-            continue
-        error = [float(error[x]) for x in range(len(error)) if not math.isnan(float(error[x]))]
-        try:
-            time = [time[x] for x in range(len(time)) if not math.isnan(float(mags[x]))]
-        except IndexError:
+        # only keep the data points taken in this filter (the other filters' magnitudes are nan)
+        indices = [x for x in indices if not np.isnan(sources['MAG_'+filt][x])]
+        if len(indices)==0:
             print('\tNo %s magnitude data found' % filt)
             sleep(0.5)
             print('\tReturning to Star Lookup')
@@ -272,6 +250,10 @@ while True:
             header()
             sleep(0.5)
             continue
+
+        mags = [sources['MAG_'+filt][x] for x in indices]
+        error = [sources['MAG_err'][x] for x in indices]
+        time = [datetime.strptime(sources['DATETIME'][x], '%Y-%m-%d %H:%M:%S.%f') for x in indices]
         mag = np.mean(mags)
         RA_comparison = np.mean([sources['RA_M'][x] for x in indices])
         DEC_comparison = np.mean([sources['DEC_M'][x] for x in indices])
@@ -279,19 +261,19 @@ while True:
         imgname_comparison = [sources['IMGNAME'][x] for x in indices][0]
         
         for j in range(len(sources['id'])):
-            if abs(float(sources['MAG_'+filt][j])-mag)<2:
-                if not sources['MAG_'+filt][j]=='---' and abs(float(sources['RA_M'][j])-RA_comparison)<0.2 and abs(float(sources['DEC_M'][j])-DEC_comparison)<0.2 and not str(sources['id'][j]).strip()=='nan' and sources['IMGNAME'][j]==imgname_comparison:
+            if abs(sources['MAG_'+filt][j]-mag)<2:
+                if abs(float(sources['RA_M'][j])-RA_comparison)<0.2 and abs(float(sources['DEC_M'][j])-DEC_comparison)<0.2 and not str(sources['id'][j]).strip()=='nan' and sources['IMGNAME'][j]==imgname_comparison:
                     possible_comparison_ids.append(sources['id'][j])
         if possible_comparison_ids==[]:
             for j in range(len(sources['id'])):
-                if abs(float(sources['MAG_'+filt][j]-mag)<6):
-                    if not sources['MAG_'+filt][j]=='---' and abs(float(sources['RA_M'][j])-RA_comparison)<0.2 and abs(float(sources['DEC_M'][j])-DEC_comparison)<0.2 and not str(sources['id'][j]).strip()=='nan' and sources['IMGNAME'][j]==imgname_comparison:
+                if abs(sources['MAG_'+filt][j]-mag)<6:
+                    if abs(float(sources['RA_M'][j])-RA_comparison)<0.2 and abs(float(sources['DEC_M'][j])-DEC_comparison)<0.2 and not str(sources['id'][j]).strip()=='nan' and sources['IMGNAME'][j]==imgname_comparison:
                         possible_comparison_ids.append(sources['id'][j])
         
         possible_comparison_ids = np.unique(possible_comparison_ids)
         for j in range(len(possible_comparison_ids)):
             possible_indices = np.nonzero(sources['id']==possible_comparison_ids[j])[0]
-            print('\t%s: %s, mag %s, N=%s' % (j+1,possible_comparison_ids[j],round(np.mean([float(sources['MAG_'+filt][x]) for x in possible_indices]),2),len(possible_indices)))
+            print('\t%s: %s, mag %s, N=%s' % (j+1,possible_comparison_ids[j],round(np.nanmean([sources['MAG_'+filt][x] for x in possible_indices]),2),len(possible_indices)))
         print('')
         comparisonid = raw_input('\tComparison star selction (or enter for no comparison star): ')
 
@@ -309,19 +291,8 @@ while True:
         # comparison
         if not comparisonid=='':
             comparisonid = possible_comparison_ids[int(comparisonid)-1]
-            comparison_indices = np.nonzero(sources['id']==comparisonid)[0]
-            mags_comparison,error_comparison,time_comparison = [],[],[]
-            for x in comparison_indices:
-                mags_comparison.append(sources['MAG_'+filt][x])
-                error_comparison.append(sources['MAG_err'][x])
-                time_comparison.append(datetime.strptime(sources['DATETIME'][x], '%Y-%m-%d %H:%M:%S.%f'))
-
-            mags_comparison = [float(mags_comparison[x]) for x in range(len(mags_comparison)) if not math.isnan(float(mags_comparison[x]))]
-
-            error_comparison = [float(error_comparison[x]) for x in range(len(error_comparison)) if not math.isnan(float(error_comparison[x]))]
-            try:
-                time_comparison = [time_comparison[x] for x in range(len(time_comparison)) if not math.isnan(float(mags_comparison[x]))]
-            except IndexError:
+            comparison_indices = [x for x in np.nonzero(sources['id']==comparisonid)[0] if not np.isnan(sources['MAG_'+filt][x])]
+            if len(comparison_indices)==0:
                 print('\tNo %s magnitude data found' % filt)
                 sleep(0.5)
                 print('\tReturning to Star Lookup')
@@ -331,11 +302,14 @@ while True:
                 header()
                 sleep(0.5)
                 continue
+            mags_comparison = [sources['MAG_'+filt][x] for x in comparison_indices]
+            error_comparison = [sources['MAG_err'][x] for x in comparison_indices]
+            time_comparison = [datetime.strptime(sources['DATETIME'][x], '%Y-%m-%d %H:%M:%S.%f') for x in comparison_indices]
             plt.errorbar(time_comparison,mags_comparison,yerr=error_comparison,label='comparison %s' % comparisonid,fmt='mx',ms=5,mew=1.5,elinewidth=0.5,capsize=1,capthick=0.5)
         
         duration = end - start
         date_list = [start + timedelta(seconds=x) for x in range(0, int(duration.total_seconds()))]
-        cmag = np.mean([float(sources['CMAG_'+filt][c]) for c in indices])
+        cmag = np.nanmean([sources['CMAG_'+filt][c] for c in indices])
         cmags = [cmag for r in range(len(date_list))]
         
         plt.plot(date_list,cmags,linestyle='dashdot',color='black',label='cataog mag')
@@ -430,16 +404,11 @@ while True:
         mags,time = [[],[],[]],[[],[],[]]
         for x in indices:
             for j in range(len(filt)):
-                if sources['MAG_'+filt[j]][x]=='---':
+                if not np.isnan(sources['MAG_'+filt[j]][x]): # nan unless the image was taken in this filter
                     mags[j].append(sources['MAG_'+filt[j]][x])
-                else:
-                    mags[j].append(float(sources['MAG_'+filt[j]][x]))
-                time[j].append(datetime.strptime(sources['DATETIME'][x], '%Y-%m-%d %H:%M:%S.%f'))
+                    time[j].append(datetime.strptime(sources['DATETIME'][x], '%Y-%m-%d %H:%M:%S.%f'))
 
         nodata = 0
-        for j in range(len(filt)):
-            time[j] = [time[j][x] for x in range(len(time[j])) if isinstance(mags[j][x], float)]
-            mags[j] = [mags[j][x] for x in range(len(mags[j])) if isinstance(mags[j][x], float)]
         
 
         saveflag = raw_input("\tSave plot as file? [y/n]: ")
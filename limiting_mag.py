@@ -9,13 +9,13 @@ import glob
 print("\033c")
 
 def openData(filename):
-    with open(filename) as csvFile:
-        reader = csv.reader(csvFile)
-        keys = next(reader)
+    df = pd.read_csv(filename)
     dictionary = dict()
-    for i in keys:
-        df = pd.read_csv(filename)
-        dictionary[i]=np.array(df[i])
+    for i in df.columns:
+        if i.startswith('MAG') or i.startswith('CMAG'):
+            dictionary[i] = np.array(pd.to_numeric(df[i],errors='coerce')) # rows written before the numeric output used '---' for other filters
+        else:
+            dictionary[i] = np.array(df[i])
     return dictionary
 
 sources = openData('sources.csv')
@@ -38,7 +38,9 @@ for filename in filenames:
     identifiers = [sources['id'][x] for x in indices]
     identifiers = np.unique(identifiers)
     for starid in identifiers:
-        current_mags = [sources['MAG_'+filt][j] for j in indices if sources['id'][j]==starid]
+        current_mags = [sources['MAG_'+filt][j] for j in indices if sources['id'][j]==starid and not np.isnan(sources['MAG_'+filt][j])]
+        if len(current_mags)==0:
+            continue
         stds.append(np.std(current_mags))
         mags.append(np.mean(current_mags))
         data.append(len(current_mags))
@@ -24,10 +24,19 @@ import os # for interacting with the terminal
 import warnings # for suppressing warnings
 import csv # for reading/writing from csv files
 import shutil # solely for copying .SRC files between directories 
+import glob # for finding cutout files to re-measure
+import hashlib # for keying cached intermediate products on image content
+import itertools # for making star quads when plate solving
+import threading # for writing calibrated images in the background
+import Queue # for handing images to the writer thread
+import atexit # for making sure queued images are written before exiting
+import bisect # for finding the master closest in time to an image
+import io # for parsing the new lines of sources.csv as a table
 from datetime import datetime,timedelta
 from time import strftime, gmtime, strptime, sleep, localtime
 import datetime as dt
 from collections import OrderedDict # make Python 2.7 dictionary act like 3.6 dictionary 
+from multiprocessing.pool import ThreadPool, Pool # for running source extraction on several tiles of an image at once
 import pandas as pd
 
 # astro packages
@@ -72,6 +81,34 @@ end_time = ''
 slow = False 
 days_old = 1 
 verbose_errors = False 
+catalog_cache = True # keep a local copy of catalog queries in catalog_cache_path, so repeat fields need no network access
+catalog_cache_path = 'CatalogCache/'
+catalog_cache_size = 500.0 # maximum size of the catalog cache in MB, least recently used sky tiles are deleted past this
+catalog_tile_size = 0.5 # height of the sky tiles (in degrees of declination) the catalog cache is split into
+catalog_backend = 'vizier' # 'vizier' to query over the network or 'local' to read a catalog ingested with ingestCatalog()
+local_catalog_path = 'LocalCatalog/' # where ingestCatalog() writes and the local backend reads the catalog
+vizier_server = None # set to e.g. 'localhost:8080' to send Vizier queries to a serveCatalog() stand-in
+quad_index_path = 'QuadIndex/' # where buildQuadIndex() writes and the plate solver reads the star quad index
+master_library_path = 'MasterCal/' # masters in here and its archive/ subfolders are indexed to find the one closest in time to each image
+master_cache_size = 12 # most master frames kept in memory, least recently used ones are dropped past this
+calibration_cache_size = 6 # most calibration offsets (and reciprocal flats) kept in memory, least recently used ones are dropped past this
+master_temp_tolerance = 2.0 # largest difference in degrees C between the CCD-TEMP of an image and of the bias and dark used for it
+sensor_shape = (2532,3352) # rows and columns of the camera sensor at binning 1x1, full frames at binning n are this over n
+calibration_binnings = [1,2,3] # binnings we keep masters for and calibrate
+image_compression = None # None to write calibrated images, stacks and masters as plain float32, or 'RICE_1', 'GZIP_1' or 'GZIP_2' to tile compress them
+quantize_level = 16.0 # with compression, quantize to the noise in each tile over this (larger keeps more precision), 0 for lossless (GZIP only)
+
+# counters for the run summary (do not change)
+catalog_hits = 0
+catalog_misses = 0
+quality_passed = 0
+quality_rejected = 0
+master_loads = 0
+master_bytes = 0
+master_reuses = 0
+master_evictions = 0
+skipped_frames = 0 # frames rejected for calibration from the header alone
+skipped_bytes = 0 # pixel data of those frames that was never read
 
 
 
@@ -151,21 +188,17 @@ def sendStatus():
     # print header
     header('Sending Update')
     
-    # read CSV file with output data
-    with open('sources.csv') as csvFile:
-        reader = csv.reader(csvFile)
-        keys = next(reader)
-    dictionary = dict()
-    for i in keys:
-        df = pd.read_csv('sources.csv')
-        dictionary[i]=np.array(df[i])
-    sources = dictionary
-
-    # define variables using list comprehension from the output data
-    images_processed = len(np.unique([sources['IMGNAME'][x] for x in range(len(sources['IMGNAME'])) if isinstance(sources['RUNTIME'][x],str) and datetime.strptime(sources['RUNTIME'][x],"%Y-%m-%d %H:%M GMT").day==datetime.utcnow().day]))
-    stars_logged = len(np.unique([sources['id'][x] for x in range(len(sources['id'])) if isinstance(sources['RUNTIME'][x],str) and datetime.strptime(sources['RUNTIME'][x],"%Y-%m-%d %H:%M GMT").day==datetime.utcnow().day]))
+    # read CSV file with output data, only the columns we need
+    sources = pd.read_csv('sources.csv',usecols=['id','IMGNAME','RUNTIME'])
+
+    # rows written today (RUNTIME is a fixed format string, so compare the day in one pass)
+    runtime = pd.to_datetime(sources['RUNTIME'],format="%Y-%m-%d %H:%M GMT",errors='coerce')
+    today = np.array(runtime.dt.day==datetime.utcnow().day)
+    unmatched = np.array(sources['id'].isnull())
+    images_processed = len(np.unique(sources['IMGNAME'][today].astype(str)))
+    stars_logged = len(np.unique(sources['id'][today & ~unmatched].astype(str)))
     if not images_processed==0:
-        stars_not_matched = round(float(len([sources['id'][x] for x in range(len(sources['id'])) if str(sources['id'][x])=='nan' and isinstance(sources['RUNTIME'][x],str) and datetime.strptime(sources['RUNTIME'][x],"%Y-%m-%d %H:%M GMT").day==datetime.utcnow().day]))/float(images_processed),2)
+        stars_not_matched = round(float(np.sum(today & unmatched))/float(images_processed),2)
     else:
         stars_not_matched = 0
 
@@ -193,8 +226,7 @@ def sendStatus():
     Completed %s<br />
     Unique images processed: %s<br />
     Unique stars logged: %s<br />
-    Stars not matched to catalog (avg): %s<br /><br />
-
+    Stars not matched to catalog (avg): %s<br />
     """ % (start_time,end_time,images_processed,stars_logged,stars_not_matched)
     
     # same thing but without HTML
@@ -206,6 +238,16 @@ def sendStatus():
     Stars not matched to catalog (avg): %s
     """ % (start_time,end_time,images_processed,stars_logged,stars_not_matched)
 
+    # statistics kept by the module during this run
+    run_stats = [('Catalog cache hits/misses','%s/%s' % (catalog_hits,catalog_misses)),
+                 ('Master frames loaded','%s (%.1f MB, reused %s times, %s dropped from memory)' % (master_loads,master_bytes/1e6,master_reuses,master_evictions)),
+                 ('Pixel reads skipped for rejected frames','%s (%.1f MB)' % (skipped_frames,skipped_bytes/1e6)),
+                 ('Images rejected by quality check','%s of %s' % (quality_rejected,quality_passed+quality_rejected))]
+    for label,value in run_stats:
+        body += "    %s: %s<br />\n" % (label,value)
+        printing += "    %s: %s\n" % (label,value)
+    body += "<br />\n\n"
+
     body += "Here are the log entries for today's run:\n<p style='font-size:8pt;'>"
 
     # include summary of error log for today
@@ -556,16 +598,15 @@ def makeMasters(directory=str,inPipeline=False,writeOver=False):
                 if j+i+'_master' in locals(): # if the local variable is defined
                     if writeOver:
                         # move current masters to old folder
-                        with fits.open('MasterCal/binning'+i+'/'+j+'_master.fit') as old_hdulist:
-                            old_hdr = old_hdulist[0].header
-                            date = old_hdr['DATE-OBS'] # date image was taken
+                        old_hdr = imageHeader('MasterCal/binning'+i+'/'+j+'_master.fit')
+                        date = old_hdr['DATE-OBS'] # date image was taken
                         date = date[0:4] + date[5:7] + date[8:10]
                         archivepath = 'MasterCal/archive/'+date+'/binning'+i+'/'
                         if not os.path.exists(archivepath):
                             os.makedirs(archivepath)
                         shutil.move('MasterCal/binning'+i+'/'+j+'_master.fit',archivepath+j+'_master.fit')
                     try:
-                        code = "fits.writeto('MasterCal/binning"+i+'/'+j+"_master.fit',"+j+i+'_master, header='+j+i+'_header,overwrite='+str(writeOver)+')' # write to MasterCal/binningi
+                        code = "writeImage('MasterCal/binning"+i+'/'+j+"_master.fit',"+j+i+'_master, header='+j+i+'_header,overwrite='+str(writeOver)+')' # write to MasterCal/binningi
                         exec(code)
                         print('Wrote master %s to file MasterCal/binning%s/%s_master.fit' % (j,i,j))   
                     except:
@@ -576,16 +617,15 @@ def makeMasters(directory=str,inPipeline=False,writeOver=False):
             for j in f: # for each unique filter
                 if writeOver:
                     # move current masters to old folder
-                    with fits.open('MasterCal/binning'+i+'/flat_master_'+j+'.fit')[0] as old_hdulist:
-                        old_hdr = old_hdulist[0].header
-                        date = old_hdr['DATE-OBS'] # date image was taken
+                    old_hdr = imageHeader('MasterCal/binning'+i+'/flat_master_'+j+'.fit')
+                    date = old_hdr['DATE-OBS'] # date image was taken
                     date = date[0:4] + date[5:7] + date[8:10]
                     archivepath = 'MasterCal/archive/'+date+'/binning'+i+'/'
                     if not os.path.exists(archivepath):
                         os.makedirs(archivepath)
                     shutil.move('MasterCal/binning'+i+'/flat_master_'+j+'.fit',archivepath+'flat_master_'+j+'.fit')
                 try:
-                    code = "fits.writeto('MasterCal/binning"+i+'/'+"flat_master_"+j+".fit',"+j+i+"_master,header="+j+i+"_header,overwrite="+str(writeOver)+")"
+                    code = "writeImage('MasterCal/binning"+i+'/'+"flat_master_"+j+".fit',"+j+i+"_master,header="+j+i+"_header,overwrite="+str(writeOver)+")"
                     exec(code)   
                     print('Wrote master %s flat to file MasterCal/binning%s/flat_master_%s.fit' % (j,i,j))
                 except:
@@ -593,10 +633,1471 @@ def makeMasters(directory=str,inPipeline=False,writeOver=False):
         
         print('Complete')
         sleep(3)
-        
 
 
 
+#####################################################################################################################################################
+### background writer for calibrated images, so Reduce doesn't wait on the disk
+#####################################################################################################################################################
+
+write_queue = None # images waiting to be written, made along with the writer thread the first time it's needed
+write_queue_size = 2 # most calibrated images waiting to be written before Reduce waits for the disk
+write_errors = [] # images the writer thread failed to write, logged by flushWrites()
+
+def writeBehind(filename,data,hdr):
+    '''
+    Internal function.
+    Queues an image to be written to filename by the writer thread, starting the thread the first time. Blocks while
+    write_queue_size images are already waiting, so a slow disk holds up the pipeline instead of filling up the memory.
+    The data and header must not be changed after they are queued.
+    '''
+    global write_queue
+    if write_queue is None:
+        write_queue = Queue.Queue(maxsize=write_queue_size)
+        writer = threading.Thread(target=fitsWriter,args=(write_queue,))
+        writer.daemon = True
+        writer.start()
+        atexit.register(flushWrites) # don't lose queued images when a script ends right after Reduce()
+    write_queue.put((filename,data,hdr))
+
+def fitsWriter(queue):
+    '''
+    Internal function.
+    Writer thread, writes the queued images one at a time.
+    '''
+    while True:
+        filename,data,hdr = queue.get()
+        try:
+            writeImage(filename,data,hdr,overwrite=True)
+        except Exception as e:
+            write_errors.append('%s (%s)' % (filename,e))
+        queue.task_done()
+
+def flushWrites():
+    '''
+    Waits until every queued image has been written, and logs any that failed.
+    Run before reading calibrated images back from disk and at the end of the pipeline.
+    '''
+    if write_queue is not None:
+        write_queue.join()
+    while write_errors:
+        writeError('     in saveFits: Failed to write %s' % write_errors.pop(0))
+
+
+
+#####################################################################################################################################################
+### master frame cache, so each master is read once per run instead of once per image
+#####################################################################################################################################################
+
+master_cache = OrderedDict() # least recently used first
+master_index = None # master library, made by masterIndex() the first time it's needed
+
+def writeImage(filename,data,header=None,overwrite=False):
+    '''
+    Internal function.
+    Writes an image as float32, uncompressed or, if image_compression is set, as a tile-compressed HDU after an empty
+    primary HDU. The data is converted to a big-endian copy first, since astropy byte swaps little-endian data in place
+    while writing it and the caller may still be using the array (e.g. the background writer).
+    '''
+    data = np.asarray(data,dtype='>f4')
+    if image_compression is None:
+        fits.writeto(filename,data,header,overwrite=overwrite)
+    else:
+        hdu = fits.CompImageHDU(data,header,compression_type=image_compression,quantize_level=quantize_level)
+        fits.HDUList([fits.PrimaryHDU(),hdu]).writeto(filename,overwrite=overwrite)
+
+def imageHDU(hdulist):
+    '''
+    Internal function.
+    Returns the first HDU of an open fits file that holds an image: the primary HDU of a plain file, or the
+    tile-compressed HDU after the empty primary of a compressed one.
+    '''
+    for hdu in hdulist:
+        if hdu.header.get('NAXIS',0)>0:
+            return hdu
+    return hdulist[0]
+
+def imageHeader(filename):
+    '''
+    Internal function.
+    Reads just the image header of a plain or compressed fits file.
+    '''
+    with fits.open(filename) as hdulist:
+        return imageHDU(hdulist).header.copy()
+
+def readFits(filename):
+    '''
+    Internal function.
+    Returns the image header and data of a plain or compressed fits file, with the data as a native-endian float32 array.
+    Plain files are memory mapped and the raw (big-endian) values are converted straight into the float32 buffer, then
+    BSCALE/BZERO are applied in place and taken out of the header, so the pixels are only copied once.
+    '''
+    with fits.open(filename,memmap=True,do_not_scale_image_data=True) as hdulist:
+        hdu = imageHDU(hdulist)
+        hdr = hdu.header.copy()
+        raw = hdu.data
+        data = np.empty(raw.shape,dtype='=f4')
+        data[...] = raw # the one byte swap and conversion
+        del raw
+    bscale,bzero = hdr.get('BSCALE',1),hdr.get('BZERO',0)
+    hdr.remove('BSCALE',ignore_missing=True)
+    hdr.remove('BZERO',ignore_missing=True)
+    if bscale!=1:
+        data *= np.float32(bscale)
+    if bzero!=0:
+        data += np.float32(bzero) # e.g. 32768 for unsigned 16 bit camera images, exact in float32
+    return hdr,data
+
+def loadMaster(filename):
+    '''
+    Internal function.
+    Returns the header and data of a master calibration frame, with the data as a native-endian float32 array.
+    Masters are kept in memory until clearMasters(), unless the file changes in the meantime, up to master_cache_size of
+    them; past that the least recently used one is dropped. Raises IOError if the master can't be opened.
+    '''
+    global master_loads,master_bytes,master_reuses,master_evictions
+    mtime = os.path.getmtime(filename)
+    if filename in master_cache and master_cache[filename][0]==mtime:
+        master_reuses += 1
+        master_cache[filename] = master_cache.pop(filename) # now the most recently used
+        return master_cache[filename][1],master_cache[filename][2]
+
+    hdr,data = readFits(filename)
+    stale = master_cache.pop(filename,None) is not None # a master changed
+    while len(master_cache)>=max(master_cache_size,1):
+        master_cache.popitem(last=False)
+        master_evictions += 1
+        stale = True
+    if stale: # drop the calibration plans, which may have been made from a master no longer in memory
+        calibration_plans.clear()
+        calibration_offsets.clear()
+        inverse_flats.clear()
+    master_cache[filename] = (mtime,hdr,data)
+    master_loads += 1
+    master_bytes += data.nbytes
+    return hdr,data
+
+
+def observationTime(date):
+    '''
+    Internal function.
+    Seconds since 1970 of a DATE-OBS value, with or without fractional seconds.
+    '''
+    return (datetime.strptime(date[0:19],'%Y-%m-%dT%H:%M:%S')-datetime(1970,1,1)).total_seconds()
+
+def masterIndex():
+    '''
+    Internal function.
+    Indexes the headers of every master in master_library_path, including the ones makeMasters() moved to archive/,
+    the first time it is run. Returns a dictionary with a (type, binning, filter) key, where filter is None for bias and
+    dark, holding the DATE-OBS times of those masters in order and a matching list of their filename, EXPTIME and CCD-TEMP.
+    '''
+    global master_index
+    if master_index is not None:
+        return master_index
+    masters = []
+    for path,dirs,files in os.walk(master_library_path):
+        for name in files:
+            if name in ['bias_master.fit','dark_master.fit']:
+                typ,filt = name.split('_')[0],None
+            elif name.startswith('flat_master_') and name.endswith('.fit'):
+                typ,filt = 'flat',name[12:-4]
+            else:
+                continue
+            filename = os.path.join(path,name)
+            try:
+                h = imageHeader(filename)
+                binning = h['XBINNING']
+                if (h['NAXIS2'],h['NAXIS1'])!=(sensor_shape[0]//binning,sensor_shape[1]//binning):
+                    continue # not a full frame master, can't be used for every image at this binning
+                masters.append(((typ,binning,filt),observationTime(h['DATE-OBS']),filename,h.get('EXPTIME'),h.get('CCD-TEMP')))
+            except Exception as e:
+                writeError('     in masterIndex: Could not index master %s (%s)' % (filename,e))
+
+    master_index = {}
+    for key,time,filename,exptime,temp in sorted(masters):
+        times,entries = master_index.setdefault(key,([],[]))
+        times.append(time)
+        entries.append((filename,exptime,temp))
+    print('Indexed %s masters in %s' % (len(masters),master_library_path))
+    return master_index
+
+def selectMaster(typ,h):
+    '''
+    Internal function.
+    Filename of the bias, dark or flat master (typ) closest in time to the image with header h, from masterIndex().
+    Bias and dark masters also need a CCD-TEMP within master_temp_tolerance of the image's. The closest master is found
+    with a binary search, then the ones on either side are tried in order of time difference until one is valid.
+    Returns None if there is no valid master.
+    '''
+    key = (typ,h['XBINNING'],h['FILTER'] if typ=='flat' else None)
+    if key not in masterIndex():
+        return None
+    times,entries = masterIndex()[key]
+    time = observationTime(h['DATE-OBS'])
+    temp = h.get('CCD-TEMP')
+    after = bisect.bisect_left(times,time)
+    before = after-1
+    while before>=0 or after<len(times):
+        if after>=len(times) or (before>=0 and time-times[before]<=times[after]-time):
+            i,before = before,before-1
+        else:
+            i,after = after,after+1
+        filename,exptime,master_temp = entries[i]
+        if typ=='flat' or temp is None or master_temp is None or abs(temp-master_temp)<=master_temp_tolerance:
+            return filename
+    return None
+
+
+def clearMasters():
+    '''
+    Releases the cached master frames and calibration plans (run at the end of the pipeline), and the master library
+    index so the next run sees new masters.
+    '''
+    global master_index
+    master_index = None
+    master_cache.clear()
+    calibration_plans.clear()
+    calibration_offsets.clear()
+    inverse_flats.clear()
+
+
+calibration_plans = OrderedDict() # least recently used first, in all three
+calibration_offsets = OrderedDict()
+inverse_flats = OrderedDict()
+
+def recentlyUsed(cache,key,make):
+    '''
+    Internal function.
+    Returns cache[key], making it with make() if it isn't there, and marks it as the most recently used entry. Past
+    calibration_cache_size entries, the least recently used ones are dropped.
+    '''
+    if key in cache:
+        cache[key] = cache.pop(key)
+    else:
+        while len(cache)>=max(calibration_cache_size,1):
+            cache.popitem(last=False)
+        cache[key] = make()
+    return cache[key]
+
+def calibrationPlan(masters,exptime,bias,flat,dark=None,dxptime=None):
+    '''
+    Internal function.
+    Returns the (offset, reciprocal flat) frames that calibrate a light frame as (light - offset) * reciprocal_flat,
+    where offset = bias + (exptime/dxptime)*dark, or just the bias if dark is None (the image already had an auto dark).
+    masters is the (bias, dark, flat) filenames, which fix the binning and filter. Plans are kept per set of masters and
+    exposure time, since a night only uses a handful of exposure times; the offset is shared between filters and the
+    reciprocal flat between exposure times. Each is a full frame, so at most calibration_cache_size of them are kept
+    (least recently used dropped first), and all are dropped when a master is dropped from memory.
+    '''
+    bias_filename,dark_filename,flat_filename = masters
+    offset_key = (bias_filename,None,None) if dark is None else (bias_filename,dark_filename,exptime)
+    key = offset_key+(flat_filename,)
+    def plan():
+        if dark is None:
+            offset = recentlyUsed(calibration_offsets,offset_key,lambda: bias)
+        else: # scale the dark linearly w/ exptime
+            offset = recentlyUsed(calibration_offsets,offset_key,lambda: bias+np.float32(float(exptime)/float(dxptime))*dark)
+        inverse_flat = recentlyUsed(inverse_flats,flat_filename,lambda: np.float32(1.0)/flat) # the flat is already normalized
+        return (offset,inverse_flat)
+    return recentlyUsed(calibration_plans,key,plan)
+
+def frameWindow(h):
+    '''
+    Internal function.
+    Returns the (rows, columns) slices of a full frame at the image's binning that the image covers, from the
+    XORGSUBF/YORGSUBF subframe origin in binned pixels (0,0 for full frames), so subframes can be calibrated with views
+    of the full size masters. Returns None if the binning isn't one we calibrate or the image doesn't fit on the sensor.
+    '''
+    binning = h.get('XBINNING',1)
+    if binning not in calibration_binnings or h.get('YBINNING',binning)!=binning:
+        return None
+    rows,columns = sensor_shape[0]//binning,sensor_shape[1]//binning # e.g. 844 x 1117 at 3x3
+    x0,y0 = int(h.get('XORGSUBF',0)),int(h.get('YORGSUBF',0))
+    nx,ny = h.get('NAXIS1',0),h.get('NAXIS2',0)
+    if nx<1 or ny<1 or x0<0 or y0<0 or x0+nx>columns or y0+ny>rows:
+        return None
+    return (slice(y0,y0+ny),slice(x0,x0+nx))
+
+def calibrateFrame(light,offset,inverse_flat,rows=None):
+    '''
+    Internal function.
+    Calibrates a light frame as (light - offset) * inverse_flat in place in its own float32 buffer, so no full frame
+    temporaries are made (light is only copied if it isn't already a writeable native float32 array). With rows set, the
+    frame is done that many rows at a time so each chunk is still in cache for the multiply.
+    Everything is float32, so the result is within 4 float32 roundings (4*2**-24, about 2.4e-7) of (|light|+|offset|)/flat
+    of the float64 formula, far below the read noise; the only loss is for pixels where light and offset nearly cancel.
+    '''
+    if light.dtype!=np.dtype('=f4') or not light.flags.writeable:
+        light = np.array(light,dtype='=f4')
+    if not rows:
+        rows = light.shape[0]
+    for i in range(0,light.shape[0],rows):
+        chunk = light[i:i+rows]
+        np.subtract(chunk,offset[i:i+rows],out=chunk)
+        np.multiply(chunk,inverse_flat[i:i+rows],out=chunk)
+    return light
+
+
+#####################################################################################################################################################
+### photometry helper functions
+#####################################################################################################################################################
+
+# annulus pixel offsets are the same for every star with the same radii, so we only compute them once per (r_in, r_out)
+annulus_offsets = {}
+
+def annulusOffsets(r_in,r_out):
+    '''
+    Internal function.
+    Returns the (dx,dy) pixel offsets that fall strictly between r_in and r_out, memoized for each pair of radii.
+    Covers the same square from -int(r_out) to int(r_out)-1 that the original per-pixel loop did.
+    '''
+    key = (float(r_in),float(r_out))
+    if key not in annulus_offsets:
+        d = np.arange(-int(r_out),int(r_out))
+        dx,dy = np.meshgrid(d,d,indexing='ij')
+        dist = np.sqrt(dx*dx+dy*dy)
+        inside = (dist>r_in) & (dist<r_out) # if the distance from center is within annulus boundaries
+        annulus_offsets[key] = (dx[inside],dy[inside])
+    return annulus_offsets[key]
+
+
+def annulusBackground(img,x,y,r_in,r_out,cutoff=True):
+    '''
+    Internal function.
+    Measures the mean background in an annulus around every (x,y) position at once.
+    Pixels that fall off the edge of the image (or are nan) are masked, and if cutoff=True outliers more than 3 std deviations
+    above the mean are iteratively removed (3 passes) with masked arrays.
+    Returns an array of background means, one per position.
+    '''
+    dx,dy = annulusOffsets(r_in,r_out)
+    x = np.atleast_1d(np.asarray(x,dtype=float))
+    y = np.atleast_1d(np.asarray(y,dtype=float))
+
+    # pixel indices for every (source, annulus pixel) pair, truncated the same way int() does
+    x_index = np.trunc(x[:,None]+dx[None,:]).astype(int)
+    y_index = np.trunc(y[:,None]+dy[None,:]).astype(int)
+    edge = (x_index<0) | (x_index>=img.shape[1]) | (y_index<0) | (y_index>=img.shape[0])
+    x_index[edge] = 0
+    y_index[edge] = 0
+
+    # gather every annulus in one indexed operation (nan pixels, e.g. off the edge of a cutout, are masked too)
+    values = img[y_index,x_index].astype(float)
+    annulus_values = np.ma.masked_array(values,mask=edge | ~np.isfinite(values))
+
+    ## cutoff outliers from the annulus
+    if cutoff:
+        for j in range(3): # iteratively remove outliers
+            std = annulus_values.std(axis=1)
+            mean = annulus_values.mean(axis=1)
+            annulus_values = np.ma.masked_where(annulus_values>(mean+3*std)[:,None],annulus_values) # if outliers are above 3 std deviations
+
+    return np.ma.filled(annulus_values.mean(axis=1),np.nan)
+
+
+def aperturePhotometry(img,x,y,r,bkg_mean,gain):
+    '''
+    Internal function.
+    Sums the flux in circular apertures of radius r at every (x,y) position with a single sep call, then removes each
+    star's local background analytically (bkg_mean * aperture area) instead of subtracting it from a copy of the image.
+    Returns arrays of fluxes, flux errors (Poisson noise of the background subtracted flux) and sep flags.
+    '''
+    flux, fluxerr, flag = sep.sum_circle(img, x, y, r, subpix=0)
+
+    # subpix=0 uses exact pixel overlap, so an untruncated aperture covers exactly pi*r^2 pixels
+    # (truncated apertures get flag 16 and are discarded anyway)
+    flux = flux - np.asarray(bkg_mean)*np.pi*np.asarray(r)**2
+    fluxerr = np.sqrt(np.clip(flux,0,None)/gain) # same as sep's gain term on a background subtracted image
+    return flux, fluxerr, flag
+
+
+# fixed column layout of the photometry results written to sources.csv and apertures.csv, missing values are NaN
+output_dtype = [('id','S16'),('RA_C','<f8'),('DEC_C','<f8'),('RA_M','<f8'),('DEC_M','<f8'),('DIF','<f8'),
+                ('MAG_R','<f8'),('MAG_V','<f8'),('MAG_B','<f8'),('MAG_err','<f8'),('CMAG_R','<f8'),('CMAG_V','<f8'),('CMAG_B','<f8'),
+                ('DATETIME','S26'),('IMGNAME','S128'),('RUNTIME','S20')]
+aperture_dtype = [('IMGNAME','S128'),('RA_M','<f8'),('DEC_M','<f8'),('RADIUS','<f8'),('FLUX','<f8'),('FLUXERR','<f8'),('FLAG','<i4'),('APCORR','<f8')]
+
+def makeOutput(n,dtype=output_dtype):
+    '''
+    Internal function.
+    Returns an empty table of n photometry results, with NaN in every float column and 'nan' as the id.
+    '''
+    output = np.zeros(n,dtype=dtype)
+    for name in output.dtype.names:
+        if output.dtype[name].kind=='f':
+            output[name] = np.nan
+    if 'id' in output.dtype.names:
+        output['id'] = 'nan'
+    return output
+
+def writeTable(filename,table,header=None):
+    '''
+    Internal function.
+    Appends a structured array of results to a CSV file, writing the column names first if the file is new
+    (or if header is True). NaN values are written as 'nan'.
+    '''
+    if header is None:
+        header = not os.path.exists(filename)
+    with open(filename, 'a') as outfile:
+        writer = csv.writer(outfile)
+        if header:
+            writer.writerow(table.dtype.names)
+        writer.writerows(table.tolist())
+
+
+def makeSourceList(x,y,radius=2.0):
+    '''
+    Internal function.
+    Builds a source list with 'x' and 'y' fields (0-based pixel positions, like sep.extract returns) from position arrays,
+    for source lists that don't come from sep.extract. The shape fields 'a', 'b' and 'theta' are filled in as circles of
+    the given radius in pixels, so code that draws the sources (e.g. Plot()) works the same on either kind of list.
+    '''
+    source = np.zeros(len(x),dtype=[('x','<f8'),('y','<f8'),('a','<f4'),('b','<f4'),('theta','<f4')])
+    source['x'] = x
+    source['y'] = y
+    source['a'] = radius
+    source['b'] = radius
+    return source
+
+
+def apertureCorrection(flux,flag):
+    '''
+    Internal function.
+    Computes the curve-of-growth aperture correction for one image from a (sources x radii) flux array.
+    Only stars with positive flux and no sep flags at every radius are used. The correction for each radius is the
+    median magnitude difference between that radius and the largest one, so that mag + correction ~ largest-aperture mag.
+    '''
+    good = np.all(flux>0,axis=1) & np.all(flag==0,axis=1)
+    if not np.any(good):
+        return np.full(flux.shape[1],np.nan)
+    growth = -2.5*np.log10(flux[good,-1][:,None]/flux[good,:])
+    return np.median(growth,axis=0)
+
+
+def zeroPoint(imags,cmags):
+    '''
+    Internal function.
+    Zero point between the instrumental and catalog magnitudes of the same stars.
+    Returns the MEDIAN of the differences (so a single variable star in the mix won't mess up our constant offset)
+    and its standard error.
+    '''
+    zero_point = np.array(cmags) - np.array(imags) # calculate the differences for each star
+    zero_point_err = np.std(zero_point)/np.sqrt(len(zero_point)) # zero point error is standard error of all differences
+    return float(np.median(zero_point)),zero_point_err
+
+
+#####################################################################################################################################################
+### re-photometry from saved cutouts
+#####################################################################################################################################################
+
+def rePhotometry(filenames,aperture_size=30.0,cutoff=True,outfile='rephotometry.csv'):
+    '''
+    Redoes the aperture photometry and zero point for every image in one or more cutout files written with
+    Field.save_cutouts (a filename, a glob pattern like 'Cutouts/2018*.fits', or a list), without opening the full frames.
+    The cutouts of each image are stacked into one tall mosaic so the annulus and aperture sums are single calls.
+    Results are appended to outfile with the same columns as sources.csv and returned as one table.
+    '''
+    if isinstance(filenames,str):
+        filenames = sorted(glob.glob(filenames))
+    runtime = strftime("%Y-%m-%d %H:%M GMT", gmtime())
+    results = []
+
+    for name in filenames:
+        with fits.open(name,memmap=True) as hdulist:
+            for stamps,table in zip(hdulist[1::2],hdulist[2::2]):
+                h,stars = stamps.header,table.data
+                imgname = h['IMGNAME']
+                if len(stars)==0:
+                    continue
+                R = h['CUTRAD']
+                r = float(aperture_size)/float(h['XBINNING'])
+                if 2.0*r>R:
+                    writeError('     in rePhotometry: annulus radius %s is larger than the %s pixel cutouts of %s, image skipped' % (2.0*r,R,imgname))
+                    continue
+
+                # stack the cutouts vertically into one image, each star at the same sub-pixel offset as in the full frame
+                cube = np.array(stamps.data,dtype='<f4')
+                n,size = np.shape(cube)[0],np.shape(cube)[1]
+                mosaic = cube.reshape(n*size,size)
+                x = stars['X']-stars['X0']
+                y = stars['Y']-stars['Y0']+np.arange(n)*size
+
+                bkg_means = annulusBackground(mosaic,x,y,1.5*r,2.0*r,cutoff=cutoff)
+                flux,fluxerr,flag = aperturePhotometry(mosaic,x,y,r,bkg_means,float(h['EGAIN']))
+                flag[~np.isfinite(flux)] |= 16 # aperture runs off the edge of the original image
+                keep = (flag<=7) & (flux>0)
+
+                output = makeOutput(np.sum(keep))
+                for key in ['id','RA_C','DEC_C','RA_M','DEC_M','DIF']:
+                    output[key] = stars[key][keep]
+                imags = -2.5*np.log10(flux[keep])
+                imags_err = 1/fluxerr[keep]
+                cmags = stars['CMAG'][keep]
+                matched = ~np.isnan(cmags)
+                if not np.any(matched):
+                    writeError('     in rePhotometry: no catalog stars left for the zero point of %s, image skipped' % imgname)
+                    continue
+                zero_point,zero_point_err = zeroPoint(imags[matched],cmags[matched])
+
+                filt = h['FILTER']
+                output['MAG_err'] = np.sqrt(imags_err*imags_err+zero_point_err*zero_point_err)
+                if 'MAG_'+filt in output.dtype.names:
+                    output['MAG_'+filt] = imags+zero_point
+                    output['CMAG_'+filt] = cmags
+                output['DATETIME'] = datetime.strptime(h['DATE-OBS'],'%Y-%m-%dT%H:%M:%S.%f').strftime('%Y-%m-%d %H:%M:%S.%f')
+                output['IMGNAME'] = imgname
+                output['RUNTIME'] = runtime
+                results.append(output)
+        print('Re-measured %s images from %s' % (len(results),name))
+
+    results = np.concatenate(results) if results else makeOutput(0)
+    if outfile:
+        writeTable(outfile,results)
+    return results
+
+
+#####################################################################################################################################################
+### persistent ids for every detected source, catalogued or not
+#####################################################################################################################################################
+
+assign_source_ids = False # give every detection a persistent source id at the end of each run (needs scipy, see assignSourceIDs())
+source_id_path = 'source_ids.npz' # the known sources (summed position vectors, counts, catalog ids) and how far into sources.csv they go
+
+def unitVectors(ra,dec):
+    '''
+    Internal function.
+    Converts RA/Dec in degrees to unit vectors, so distances on the sky can use a KD-tree without RA wrap or pole problems.
+    '''
+    ra,dec = np.radians(ra),np.radians(dec)
+    return np.column_stack((np.cos(dec)*np.cos(ra),np.cos(dec)*np.sin(ra),np.sin(dec)))
+
+
+def assignSourceIDs(filename='sources.csv',radius=2.0,chunk=20000):
+    '''
+    Gives every row of sources.csv a persistent internal source id, so stars without a catalog match still get light curves.
+    Detections are clustered on the sky with a KD-tree: each new detection joins the nearest known source within radius
+    arcseconds, and the rest are linked with each other friends-of-friends style to make new sources.
+    Only rows added since the last call are read (in chunks, starting from the byte offset the last call reached), so new
+    nights are attached without reclustering or re-reading the history, and ids already given out never change. Ids are
+    appended to source_ids.csv, one row per row of sources.csv (-1 if the row has no position).
+    Needs scipy, so it only runs in the pipeline if assign_source_ids is set. Returns the number of rows assigned.
+    '''
+    from scipy.spatial import cKDTree
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+
+    if not os.path.exists(filename):
+        print('No %s yet, no source ids to assign' % filename)
+        return 0
+
+    # pick up where the last call stopped
+    if os.path.exists(source_id_path):
+        with np.load(source_id_path) as state:
+            done,vectors,counts,ucac4 = int(state['rows']),state['vectors'],state['counts'],state['ucac4']
+            offset = int(state['offset']) if 'offset' in state.files else None
+    else:
+        done,offset,vectors,counts,ucac4 = 0,None,np.zeros((0,3)),np.zeros(0,dtype=int),np.zeros(0,dtype='S16')
+    link = 2*np.sin(np.radians(radius/3600.)/2) # chord length of the linking radius on the unit sphere
+
+    rows = 0
+    with open(filename,'rb') as sources:
+        header_line = sources.readline()
+        columns = next(csv.reader([header_line]))
+        if offset is None: # first call, or a state saved before the offset was kept
+            offset = len(header_line)+sum(len(sources.readline()) for i in range(done))
+        sources.seek(offset) # only the lines added since the last call are read
+        while True:
+            lines = list(itertools.islice(iter(sources.readline,b''),chunk))
+            partial = len(lines)>0 and not lines[-1].endswith(b'\n')
+            if partial: # a row still being written, leave it for next time
+                lines.pop()
+            if not lines:
+                break
+            offset += sum(len(line) for line in lines)
+            table = pd.read_csv(io.BytesIO(b''.join(lines)),header=None,names=columns,usecols=['id','RA_M','DEC_M'],dtype={'id':str})
+            xyz = unitVectors(np.array(table['RA_M'],dtype=float),np.array(table['DEC_M'],dtype=float))
+            ids = np.full(len(table),-1,dtype=int)
+            valid = np.all(np.isfinite(xyz),axis=1)
+
+            # attach detections to the nearest known source
+            if len(counts)>0:
+                centers = vectors/np.sqrt(np.sum(vectors*vectors,axis=1))[:,None]
+                dist,nearest = cKDTree(centers).query(xyz[valid],distance_upper_bound=link)
+                found = np.isfinite(dist)
+                ids[np.nonzero(valid)[0][found]] = nearest[found]
+
+            # friends-of-friends among the rest makes the new sources
+            new = np.nonzero(valid & (ids<0))[0]
+            if len(new)>0:
+                pairs = cKDTree(xyz[new]).query_pairs(link,output_type='ndarray')
+                graph = coo_matrix((np.ones(len(pairs)),(pairs[:,0],pairs[:,1])),shape=(len(new),len(new)))
+                ngroups,group = connected_components(graph,directed=False)
+                ids[new] = len(counts)+group
+                vectors = np.vstack((vectors,np.zeros((ngroups,3))))
+                counts = np.concatenate((counts,np.zeros(ngroups,dtype=int)))
+                ucac4 = np.concatenate((ucac4,np.full(ngroups,'',dtype='S16')))
+
+            # update the source positions and remember their catalog ids
+            assigned = ids>=0
+            np.add.at(vectors,ids[assigned],xyz[assigned])
+            np.add.at(counts,ids[assigned],1)
+            catalog = np.array(table['id'].fillna('nan'),dtype='S16')
+            named = assigned & (catalog!=b'nan')
+            ucac4[ids[named]] = catalog[named]
+
+            # ids are written as they are assigned, so source_ids.csv lines up row for row with sources.csv
+            newfile = not os.path.exists('source_ids.csv')
+            with open('source_ids.csv','a') as outfile:
+                writer = csv.writer(outfile)
+                if newfile:
+                    writer.writerow(['ROW','SOURCE_ID'])
+                writer.writerows(zip(range(done+rows,done+rows+len(table)),ids))
+            rows += len(table)
+            np.savez(source_id_path+'.tmp.npz',rows=done+rows,offset=offset,vectors=vectors,counts=counts,ucac4=ucac4)
+            os.rename(source_id_path+'.tmp.npz',source_id_path)
+            if partial:
+                break
+
+    print('Assigned source ids to %s new detections, %s sources known' % (rows,len(counts)))
+    return rows
+
+
+#####################################################################################################################################################
+### catalog lookup and crossmatching
+#####################################################################################################################################################
+
+catalog_columns = ['UCAC4','RAJ2000','DEJ2000','Bmag','Vmag','rmag'] # columns we request from the UCAC4 catalog
+
+def angularSeparation(ra1,dec1,ra2,dec2):
+    '''
+    Internal function.
+    Angular separation in degrees between two sets of coordinates (all in degrees), using the haversine formula.
+    Works elementwise on numpy arrays and broadcasts like any numpy operation.
+    '''
+    ra1,dec1,ra2,dec2 = [np.radians(a) for a in (ra1,dec1,ra2,dec2)]
+    h = np.sin((dec2-dec1)/2.)**2 + np.cos(dec1)*np.cos(dec2)*np.sin((ra2-ra1)/2.)**2
+    return np.degrees(2*np.arcsin(np.sqrt(np.clip(h,0,1))))
+
+
+def imageFootprint(hdr):
+    '''
+    Internal function.
+    Returns the RA, Dec of the image center and the radius (degrees) of a cone that covers the whole WCS footprint.
+    '''
+    w = wcs.WCS(hdr)
+    nx,ny = hdr['NAXIS1'],hdr['NAXIS2']
+    center = w.wcs_pix2world([[(nx+1)/2.,(ny+1)/2.]],1)[0]
+    corners = w.wcs_pix2world([[1,1],[1,ny],[nx,1],[nx,ny]],1)
+    radius = np.max(angularSeparation(center[0],center[1],corners[:,0],corners[:,1]))
+    return center[0],center[1],radius
+
+
+def queryCatalog(ra,dec,radius):
+    '''
+    Internal function.
+    Looks up every catalog star within radius (degrees) of (ra,dec) from the backend chosen by catalog_backend:
+    'vizier' queries Vizier over the network (or the server in vizier_server), 'local' reads the store made by ingestCatalog().
+    Returns a dictionary of numpy arrays keyed by catalog_columns, with masked values filled with nan.
+    '''
+    if catalog_backend=='local':
+        return queryLocal(ra,dec,radius)
+    return queryVizier(ra,dec,radius)
+
+
+def queryVizier(ra,dec,radius):
+    '''
+    Internal function.
+    Queries Vizier for every UCAC4 star within radius (degrees) of (ra,dec) in a single request.
+    If vizier_server is set (for example to a serveCatalog() stand-in) the query is sent there instead.
+    '''
+    if vizier_server is None:
+        v = Vizier(columns=catalog_columns,row_limit=-1) # lookup data in the UCAC4 catalog by querying Vizier, no row limit
+    else:
+        v = Vizier(columns=catalog_columns,row_limit=-1,vizier_server=vizier_server)
+    result = v.query_region(coord.SkyCoord(ra=ra, dec=dec, unit=(u.degree, u.degree), frame='fk5'),radius=radius*u.degree,catalog='UCAC4')
+
+    catalog = dict()
+    if len(result)==0: # no stars in the field
+        catalog['UCAC4'] = np.array([],dtype=str)
+        for c in catalog_columns[1:]:
+            catalog[c] = np.array([],dtype=float)
+        return catalog
+
+    result = result[0]
+    catalog['UCAC4'] = np.array(result['UCAC4'],dtype=str)
+    for c in catalog_columns[1:]:
+        catalog[c] = np.ma.filled(np.ma.asarray(result[c]).astype(float),np.nan)
+    return catalog
+
+
+def tileGrid(i):
+    '''
+    Internal function.
+    Returns the declination limits and number of RA tiles for declination band i of the catalog cache grid.
+    Bands are catalog_tile_size tall and split into roughly square tiles in RA.
+    '''
+    dec_lo = -90.0 + i*catalog_tile_size
+    dec_hi = min(dec_lo+catalog_tile_size,90.0)
+    n_ra = max(1,int(360.0*math.cos(math.radians((dec_lo+dec_hi)/2.))/catalog_tile_size))
+    return dec_lo,dec_hi,n_ra
+
+
+def tileIndex(ra,dec):
+    '''
+    Internal function.
+    Returns the (band, RA tile) index of the catalog cache tile containing each (ra,dec) position.
+    '''
+    ra,dec = np.atleast_1d(ra),np.atleast_1d(dec)
+    n_bands = int(math.ceil(180.0/catalog_tile_size))
+    i = np.clip(np.floor((dec+90.0)/catalog_tile_size).astype(int),0,n_bands-1)
+    n_ra = np.array([tileGrid(b)[2] for b in range(n_bands)])[i]
+    j = np.floor((ra%360.0)/360.0*n_ra).astype(int) % n_ra
+    return i,j
+
+
+def catalogTiles(ra,dec,radius):
+    '''
+    Internal function.
+    Lists the (band, RA tile) indices of every catalog cache tile overlapping the cone of radius (degrees) around (ra,dec).
+    '''
+    tiles = []
+    n_bands = int(math.ceil(180.0/catalog_tile_size))
+    first = tileIndex(ra,max(dec-radius,-90.0))[0][0]
+    last = tileIndex(ra,min(dec+radius,90.0))[0][0]
+    for i in range(first,last+1):
+        dec_lo,dec_hi,n_ra = tileGrid(i)
+        # widest RA extent of the cone inside this band
+        max_dec = min(max(abs(dec_lo),abs(dec_hi)),abs(dec)+radius)
+        if max_dec>=89.9 or radius/math.cos(math.radians(max_dec))>=180.0:
+            tiles += [(i,j) for j in range(n_ra)]
+            continue
+        half_width = radius/math.cos(math.radians(max_dec))
+        j_lo = int(math.floor((ra-half_width)/360.0*n_ra))
+        j_hi = int(math.floor((ra+half_width)/360.0*n_ra))
+        tiles += sorted(set([(i,j % n_ra) for j in range(j_lo,j_hi+1)]))
+    return tiles
+
+
+def fetchTile(i,j):
+    '''
+    Internal function.
+    Queries the catalog for every star in cache tile (i,j) and returns them as a catalog dictionary.
+    '''
+    dec_lo,dec_hi,n_ra = tileGrid(i)
+    ra_lo,ra_hi = 360.0*j/n_ra,360.0*(j+1)/n_ra
+    ra_center,dec_center = (ra_lo+ra_hi)/2.,(dec_lo+dec_hi)/2.
+
+    # cone around the tile center reaching the farthest corner
+    radius = np.max(angularSeparation(ra_center,dec_center,np.array([ra_lo,ra_lo,ra_hi,ra_hi]),np.array([dec_lo,dec_hi,dec_lo,dec_hi])))
+    catalog = queryCatalog(ra_center,dec_center,radius+1/3600.)
+
+    # keep only the stars that actually belong to this tile
+    ti,tj = tileIndex(catalog['RAJ2000'],catalog['DEJ2000'])
+    inside = (ti==i) & (tj==j)
+    return dict([(c,catalog[c][inside]) for c in catalog_columns])
+
+
+def evictCatalogCache():
+    '''
+    Internal function.
+    Deletes the least recently used tiles from the catalog cache until it is smaller than catalog_cache_size.
+    '''
+    tiles = [os.path.join(catalog_cache_path,f) for f in os.listdir(catalog_cache_path) if f.endswith('.npz')]
+    tiles = sorted(tiles,key=os.path.getmtime) # oldest access first
+    total = sum([os.path.getsize(f) for f in tiles])
+    while tiles and total>catalog_cache_size*1024*1024:
+        oldest = tiles.pop(0)
+        total -= os.path.getsize(oldest)
+        os.remove(oldest)
+
+
+def lookupCatalog(ra,dec,radius):
+    '''
+    Internal function.
+    Returns every catalog star within radius (degrees) of (ra,dec), as a dictionary of arrays keyed by catalog_columns.
+    If catalog_cache is True the sky tiles covering the cone are read from catalog_cache_path when we have them and only
+    the missing tiles are queried and saved, so repeat fields are served without any network access.
+    Tiles are named by catalog_tile_size and saved with the columns and catalog source they were queried with, so a tile
+    only counts as a hit if it matches the current settings.
+    '''
+    global catalog_hits, catalog_misses
+    if not catalog_cache or catalog_backend=='local': # the local backend is already on disk
+        return queryCatalog(ra,dec,radius)
+
+    if not os.path.exists(catalog_cache_path):
+        os.makedirs(catalog_cache_path)
+
+    source = '%s:%s' % (catalog_backend,vizier_server) # where the tiles come from
+    parts = []
+    fetched = False
+    for i,j in catalogTiles(ra,dec,radius):
+        filename = os.path.join(catalog_cache_path,'tile_%g_%s_%s.npz' % (catalog_tile_size,i,j))
+        tile = None
+        if os.path.exists(filename):
+            with np.load(filename) as data:
+                # cached with the same columns, tile size and catalog source we use now
+                if list(data['columns'])==catalog_columns and 'source' in data.files and str(data['source'])==source and float(data['tile_size'])==catalog_tile_size:
+                    tile = dict([(c,data[c]) for c in catalog_columns])
+        if tile is not None:
+            catalog_hits += 1
+            os.utime(filename,None) # mark as recently used
+        else:
+            catalog_misses += 1
+            tile = fetchTile(i,j)
+            np.savez(filename.replace('.npz','_tmp.npz'),columns=np.array(catalog_columns),source=source,tile_size=catalog_tile_size,**tile)
+            os.rename(filename.replace('.npz','_tmp.npz'),filename)
+            fetched = True
+        parts.append(tile)
+
+    if fetched: # the cache only grows when a tile is written
+        evictCatalogCache()
+
+    # combine the tiles and cut them down to the cone we asked for
+    catalog = dict([(c,np.concatenate([p[c] for p in parts])) for c in catalog_columns])
+    inside = angularSeparation(ra,dec,catalog['RAJ2000'],catalog['DEJ2000'])<=radius
+    return dict([(c,catalog[c][inside]) for c in catalog_columns])
+
+
+def crossMatch(ra,dec,cat_ra,cat_dec,radius):
+    '''
+    Internal function.
+    Matches every detection (ra,dec) to the nearest catalog star within radius (arcseconds) in one vectorized step,
+    using a sorted-declination window search. If several detections match the same catalog star, the closest one wins.
+    Returns the index of the matched catalog star for each detection (-1 if none) and the separation in arcseconds.
+    '''
+    ra,dec = np.asarray(ra,dtype=float),np.asarray(dec,dtype=float)
+    cat_ra,cat_dec = np.asarray(cat_ra,dtype=float),np.asarray(cat_dec,dtype=float)
+    match = np.full(len(ra),-1,dtype=int)
+    dif = np.full(len(ra),np.nan)
+    if len(ra)==0 or len(cat_ra)==0:
+        return match,dif
+
+    # find the window of catalog stars (sorted by declination) within radius in declination of each detection
+    order = np.argsort(cat_dec)
+    lo = np.searchsorted(cat_dec[order],dec-radius/3600.,side='left')
+    hi = np.searchsorted(cat_dec[order],dec+radius/3600.,side='right')
+    width = np.max(hi-lo)
+    if width==0:
+        return match,dif
+
+    # separations to every candidate in each window
+    candidates = lo[:,None]+np.arange(width)[None,:]
+    valid = candidates<hi[:,None]
+    candidates = order[np.where(valid,candidates,0)]
+    separation = angularSeparation(ra[:,None],dec[:,None],cat_ra[candidates],cat_dec[candidates])*3600.
+    separation[~valid] = np.inf
+
+    rows = np.arange(len(ra))
+    best = np.argmin(separation,axis=1)
+    matched = separation[rows,best]<=radius
+    match[matched] = candidates[rows,best][matched]
+    dif[matched] = separation[rows,best][matched]
+
+    # when two detections match the same catalog star keep only the closest one
+    n = np.nonzero(matched)[0]
+    n = n[np.lexsort((dif[n],match[n]))]
+    duplicate = np.r_[False,match[n][1:]==match[n][:-1]]
+    match[n[duplicate]] = -1
+    dif[n[duplicate]] = np.nan
+    return match,dif
+
+
+
+#####################################################################################################################################################
+### offline local catalog backend and Vizier stand-in
+#####################################################################################################################################################
+
+# memory-mapped local catalogs we have already opened, keyed by path
+local_catalogs = {}
+
+def ingestCatalog(filename,path=None,zone_height=0.1,id_column='UCAC4'):
+    '''
+    Ingests a CSV or FITS table of catalog stars into the local catalog store used when catalog_backend='local'.
+    The table must have RAJ2000, DEJ2000, Bmag, Vmag and rmag columns in degrees/magnitudes, and an ID column (id_column).
+    Stars are split into declination zones zone_height degrees tall and sorted by RA within each zone, then written as a
+    single binary catalog.npy plus an index of where each zone starts, so lookups can memory-map the file and binary search.
+    '''
+    if path is None:
+        path = local_catalog_path
+    if not os.path.exists(path):
+        os.makedirs(path)
+
+    print('Ingesting catalog %s into %s' % (filename,path))
+    if filename.endswith('.csv'):
+        table = pd.read_csv(filename)
+        columns = dict([(c,np.array(table[c])) for c in table.columns])
+    else:
+        data = fits.getdata(filename,1)
+        columns = dict([(c,np.array(data[c])) for c in data.names])
+    columns['UCAC4'] = columns[id_column]
+
+    catalog = np.zeros(len(columns['UCAC4']),dtype=[('UCAC4','S16')]+[(c,'<f8') for c in catalog_columns[1:]])
+    catalog['UCAC4'] = np.array(columns['UCAC4'],dtype=str)
+    for c in catalog_columns[1:]:
+        catalog[c] = np.array(columns[c],dtype=float)
+    catalog['RAJ2000'] = catalog['RAJ2000'] % 360.0
+
+    # sort by declination zone, then by RA within each zone
+    n_zones = int(math.ceil(180.0/zone_height))
+    zone = np.clip(np.floor((catalog['DEJ2000']+90.0)/zone_height).astype(int),0,n_zones-1)
+    order = np.lexsort((catalog['RAJ2000'],zone))
+    catalog,zone = catalog[order],zone[order]
+    starts = np.searchsorted(zone,np.arange(n_zones+1),side='left')
+
+    np.save(os.path.join(path,'catalog.npy'),catalog)
+    np.savez(os.path.join(path,'zones.npz'),starts=starts,zone_height=zone_height)
+    local_catalogs.pop(path,None) # reopen next lookup
+    print('Ingested %s stars in %s declination zones' % (len(catalog),np.count_nonzero(np.diff(starts))))
+
+
+def queryLocal(ra,dec,radius,path=None):
+    '''
+    Internal function.
+    Returns every star in the local catalog store within radius (degrees) of (ra,dec).
+    The store is memory-mapped, so only the zones and RA ranges we binary search into are ever read from disk.
+    '''
+    if path is None:
+        path = local_catalog_path
+    if path not in local_catalogs:
+        with np.load(os.path.join(path,'zones.npz')) as zones:
+            local_catalogs[path] = (np.load(os.path.join(path,'catalog.npy'),mmap_mode='r'),zones['starts'],float(zones['zone_height']))
+    catalog,starts,zone_height = local_catalogs[path]
+    n_zones = len(starts)-1
+
+    # RA ranges to search (split in two if the cone crosses RA=0)
+    max_dec = min(abs(dec)+radius,90.0)
+    if max_dec>=89.9 or radius/math.cos(math.radians(max_dec))>=180.0:
+        ra_ranges = [(0.0,360.0)]
+    else:
+        half_width = radius/math.cos(math.radians(max_dec))
+        ra_lo,ra_hi = (ra-half_width) % 360.0,(ra+half_width) % 360.0
+        ra_ranges = [(ra_lo,ra_hi)] if ra_lo<=ra_hi else [(ra_lo,360.0),(0.0,ra_hi)]
+
+    # binary search the RA range in each declination zone the cone overlaps
+    first = min(max(int(math.floor((dec-radius+90.0)/zone_height)),0),n_zones-1)
+    last = min(max(int(math.floor((dec+radius+90.0)/zone_height)),0),n_zones-1)
+    rows = []
+    for z in range(first,last+1):
+        zone_ra = catalog['RAJ2000'][starts[z]:starts[z+1]]
+        for lo,hi in ra_ranges:
+            rows.append(np.arange(starts[z]+np.searchsorted(zone_ra,lo,side='left'),starts[z]+np.searchsorted(zone_ra,hi,side='right')))
+    stars = catalog[np.concatenate(rows)] if rows else catalog[:0]
+    stars = stars[angularSeparation(ra,dec,stars['RAJ2000'],stars['DEJ2000'])<=radius]
+
+    result = dict([(c,np.array(stars[c])) for c in catalog_columns])
+    result['UCAC4'] = np.array(stars['UCAC4'],dtype=str)
+    return result
+
+
+def serveCatalog(port=8080,latency=0.0,path=None):
+    '''
+    Runs a local HTTP stand-in for Vizier that answers the cone searches astroquery sends with VOTables made from the
+    local catalog store, so the full Extract() path can be tested and benchmarked offline. Every request waits latency
+    seconds before answering, to give a fixed, repeatable network delay. Point the pipeline at it by setting
+    observatory.vizier_server = 'localhost:%s' % port (with catalog_backend left as 'vizier'). Runs until interrupted.
+    '''
+    import BaseHTTPServer
+    import re
+    from io import BytesIO
+    from astropy.table import Table
+    from astropy.io.votable import from_table, writeto
+
+    units = {'d':1.0,'m':1/60.,'s':1/3600.}
+
+    class VizierHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+        def do_POST(self):
+            # astroquery sends a script of key=value lines, e.g. -c=290.0+30.0 and -c.rd=0.3
+            script = self.rfile.read(int(self.headers.getheader('content-length',0)))
+            args = dict([line.split('=',1) for line in script.splitlines() if '=' in line])
+            ra,dec = [float(c) for c in re.match(r'([0-9.]+)([+-][0-9.]+)',args['-c']).groups()]
+            radius = [float(args['-c.r'+k])*units[k] for k in units if '-c.r'+k in args][0]
+
+            stars = queryLocal(ra,dec,radius,path=path)
+            table = Table([stars[c] for c in catalog_columns],names=catalog_columns)
+            votable = from_table(table)
+            votable.get_first_table().name = 'I/322A/out'
+            content = BytesIO()
+            writeto(votable,content)
+
+            sleep(latency)
+            self.send_response(200)
+            self.send_header('Content-Type','text/xml')
+            self.end_headers()
+            self.wfile.write(content.getvalue())
+
+        def log_message(self,format,*args):
+            pass
+
+    server = BaseHTTPServer.HTTPServer(('localhost',port),VizierHandler)
+    print('Serving local catalog as Vizier on localhost:%s' % port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+
+
+
+#####################################################################################################################################################
+### plate solving with a local index of star quads
+#####################################################################################################################################################
+
+quad_indexes = {}
+
+def tangentPlane(ra,dec,ra0,dec0):
+    '''
+    Internal function.
+    Gnomonic (TAN) projection of RA/Dec about (ra0,dec0), returns the standard coordinates xi,eta, all in degrees.
+    '''
+    ra,dec,ra0,dec0 = np.radians(ra),np.radians(dec),np.radians(ra0),np.radians(dec0)
+    cosc = np.sin(dec0)*np.sin(dec)+np.cos(dec0)*np.cos(dec)*np.cos(ra-ra0)
+    xi = np.cos(dec)*np.sin(ra-ra0)/cosc
+    eta = (np.cos(dec0)*np.sin(dec)-np.sin(dec0)*np.cos(dec)*np.cos(ra-ra0))/cosc
+    return np.degrees(xi),np.degrees(eta)
+
+
+def tangentPlaneInverse(xi,eta,ra0,dec0):
+    '''
+    Internal function.
+    Inverse of tangentPlane(), returns RA/Dec in degrees.
+    '''
+    xi,eta,ra0,dec0 = np.radians(xi),np.radians(eta),np.radians(ra0),np.radians(dec0)
+    denominator = np.cos(dec0)-eta*np.sin(dec0)
+    ra = ra0+np.arctan2(xi,denominator)
+    dec = np.arctan2(np.sin(dec0)+eta*np.cos(dec0),np.sqrt(xi*xi+denominator*denominator))
+    return np.degrees(ra) % 360.0,np.degrees(dec)
+
+
+def quadCodes(points):
+    '''
+    Internal function.
+    Geometric hash codes for quads of 4 points, shape (n,4,2). The most widely separated pair become A and B, and the
+    other two stars' positions in the frame where A=(0,0) and B=(1,1) make up the code, which doesn't change with
+    translation, rotation or scale. A/B and C/D are swapped into a fixed order so each quad has one code.
+    Returns the codes (n,4) and the order of the 4 points (n,4) they were made in.
+    '''
+    pairs = np.array([(0,1,2,3),(0,2,1,3),(0,3,1,2),(1,2,0,3),(1,3,0,2),(2,3,0,1)])
+    z = points[:,:,0]+1j*points[:,:,1]
+    separation = np.abs(z[:,pairs[:,0]]-z[:,pairs[:,1]])
+    order = pairs[np.argmax(separation,axis=1)]
+    rows = np.arange(len(z))[:,None]
+    z = z[rows,order]
+    w = (z-z[:,[0]])*(1+1j)/(z[:,[1]]-z[:,[0]])
+
+    flip = (w[:,2].real+w[:,3].real)>1 # swap A and B
+    w[flip] = (1+1j)-w[flip]
+    order[flip] = order[flip][:,[1,0,2,3]]
+    swap = w[:,2].real>w[:,3].real # swap C and D
+    w[swap] = w[swap][:,[0,1,3,2]]
+    order[swap] = order[swap][:,[0,1,3,2]]
+    return np.column_stack((w[:,2].real,w[:,2].imag,w[:,3].real,w[:,3].imag)),order
+
+
+def buildQuadIndex(ra=None,dec=None,radius=None,stars_per_tile=40,scale=(0.05,0.25),path=None):
+    '''
+    Precomputes the star quad index the plate solver matches images against, from the local catalog store
+    (see ingestCatalog()), either the whole store or the cone of radius degrees around (ra,dec).
+    The brightest stars_per_tile stars in each catalog cache tile are kept, and every pair of them between scale[0] and
+    scale[1] degrees apart makes a quad with the two brightest stars inside the circle they span.
+    Choose scale so the quads fit comfortably inside the field of view.
+    '''
+    from scipy.spatial import cKDTree
+    if path is None:
+        path = quad_index_path
+    if not os.path.exists(path):
+        os.makedirs(path)
+
+    if ra is None:
+        stars = np.load(os.path.join(local_catalog_path,'catalog.npy'),mmap_mode='r')
+        stars = dict([(c,np.array(stars[c])) for c in ['RAJ2000','DEJ2000','Vmag']])
+    else:
+        stars = queryLocal(ra,dec,radius)
+    mag = np.where(np.isnan(stars['Vmag']),99.0,stars['Vmag'])
+
+    # the brightest stars in each tile
+    i,j = tileIndex(stars['RAJ2000'],stars['DEJ2000'])
+    tile = i*100000+j
+    order = np.lexsort((mag,tile))
+    tile = tile[order]
+    rank = np.arange(len(tile))-np.searchsorted(tile,tile,side='left')
+    keep = order[rank<stars_per_tile]
+    keep = keep[np.argsort(mag[keep])] # brightest first, so lower index means brighter
+    ra_s,dec_s,mag_s = stars['RAJ2000'][keep],stars['DEJ2000'][keep],mag[keep]
+    print('Selected %s index stars from %s catalog stars' % (len(keep),len(mag)))
+
+    # every pair in the scale range, with the two brightest stars inside the circle on the pair
+    xyz = unitVectors(ra_s,dec_s)
+    tree = cKDTree(xyz)
+    chord = lambda degrees: 2*np.sin(np.radians(degrees)/2)
+    pairs = tree.query_pairs(chord(scale[1]),output_type='ndarray')
+    if len(pairs)==0:
+        print('No star pairs in the scale range, index not written')
+        return
+    pairs = pairs[np.sqrt(np.sum((xyz[pairs[:,0]]-xyz[pairs[:,1]])**2,axis=1))>=chord(scale[0])]
+    middle = xyz[pairs[:,0]]+xyz[pairs[:,1]]
+    middle /= np.sqrt(np.sum(middle*middle,axis=1))[:,None]
+    half = np.sqrt(np.sum((xyz[pairs[:,0]]-middle)**2,axis=1))
+    quads = []
+    for (a,b),center,r in zip(pairs,middle,half):
+        inside = sorted([k for k in tree.query_ball_point(center,r) if k!=a and k!=b])
+        if len(inside)>=2:
+            quads.append((a,b,inside[0],inside[1]))
+    quads = np.array(quads,dtype=np.int32).reshape(-1,4)
+
+    # codes are measured on the tangent plane at the middle of each quad
+    dec0 = np.mean(dec_s[quads],axis=1)
+    ra0 = np.degrees(np.arctan2(np.mean(np.sin(np.radians(ra_s[quads])),axis=1),np.mean(np.cos(np.radians(ra_s[quads])),axis=1))) % 360.0
+    xi,eta = tangentPlane(ra_s[quads],dec_s[quads],ra0[:,None],dec0[:,None])
+    codes,order = quadCodes(np.dstack((xi,eta)))
+    quads = quads[np.arange(len(quads))[:,None],order]
+
+    np.savez(os.path.join(path,'index.npz'),ra=ra_s,dec=dec_s,mag=mag_s,quads=quads,codes=codes.astype('<f4'),scale=np.array(scale))
+    quad_indexes.pop(path,None)
+    print('Wrote %s quads to %s' % (len(quads),path))
+
+
+def loadQuadIndex(path=None):
+    '''
+    Internal function.
+    Loads the quad index and builds the KD-trees on its codes and stars, once per run.
+    '''
+    from scipy.spatial import cKDTree
+    if path is None:
+        path = quad_index_path
+    if path not in quad_indexes:
+        with np.load(os.path.join(path,'index.npz')) as data:
+            index = dict((k,data[k]) for k in data.files)
+        index['code_tree'] = cKDTree(index['codes'])
+        index['star_tree'] = cKDTree(unitVectors(index['ra'],index['dec']))
+        quad_indexes[path] = index
+    return quad_indexes[path]
+
+
+def fitWCS(x,y,ra,dec,ra0,dec0):
+    '''
+    Internal function.
+    Least squares affine fit from FITS pixel positions (1-based) to the tangent plane about (ra0,dec0).
+    Returns the WCS header cards with the tangent point as CRVAL.
+    '''
+    xi,eta = tangentPlane(ra,dec,ra0,dec0)
+    design = np.column_stack((x,y,np.ones(len(x))))
+    (a,b,c),(d,e,f) = np.linalg.lstsq(design,xi,rcond=None)[0],np.linalg.lstsq(design,eta,rcond=None)[0]
+    cd = np.array([[a,b],[d,e]])
+    crpix = -np.linalg.solve(cd,[c,f])
+    return OrderedDict([('CTYPE1','RA---TAN'),('CTYPE2','DEC--TAN'),('CRVAL1',ra0),('CRVAL2',dec0),('CRPIX1',crpix[0]),('CRPIX2',crpix[1]),
+                        ('CD1_1',a),('CD1_2',b),('CD2_1',d),('CD2_2',e),('EQUINOX',2000.0)])
+
+
+def pixelToSky(cards,x,y):
+    '''
+    Internal function.
+    Applies WCS cards from fitWCS() to FITS pixel positions.
+    '''
+    dx,dy = np.asarray(x)-cards['CRPIX1'],np.asarray(y)-cards['CRPIX2']
+    xi = cards['CD1_1']*dx+cards['CD1_2']*dy
+    eta = cards['CD2_1']*dx+cards['CD2_2']*dy
+    return tangentPlaneInverse(xi,eta,cards['CRVAL1'],cards['CRVAL2'])
+
+
+def skyToPixel(cards,ra,dec):
+    '''
+    Internal function.
+    Inverse of pixelToSky().
+    '''
+    xi,eta = tangentPlane(ra,dec,cards['CRVAL1'],cards['CRVAL2'])
+    cd = np.array([[cards['CD1_1'],cards['CD1_2']],[cards['CD2_1'],cards['CD2_2']]])
+    dx,dy = np.linalg.solve(cd,np.vstack((xi,eta)))
+    return dx+cards['CRPIX1'],dy+cards['CRPIX2']
+
+
+def solveField(x,y,shape,ra=None,dec=None,radius=None,n_stars=20,tolerance=0.01,max_tries=500,path=None):
+    '''
+    Near-blind plate solve of a list of detections (FITS pixel positions, brightest first) on an image of shape (ny,nx).
+    Quads of the n_stars brightest detections (in both parities) are looked up in the quad index by code, each candidate
+    match gives a transform that is checked against the other index stars in the field, and the first one that checks out
+    is refined with every matched star. If a pointing (ra,dec) and radius in degrees are given only quads within that
+    radius are tried. Returns the WCS header cards, or None if no solution was found.
+    '''
+    from scipy.spatial import cKDTree
+    index = loadQuadIndex(path)
+    x,y = np.asarray(x,dtype=float),np.asarray(y,dtype=float)
+    ny,nx = shape
+    points = np.column_stack((x,y))[:n_stars]
+    if len(points)<4:
+        return None
+    detections = cKDTree(np.column_stack((x,y)))
+
+    # image quads in both parities (the image may be mirrored relative to the sky)
+    combos = np.array(list(itertools.combinations(range(len(points)),4)))
+    candidates = []
+    for parity in [1,-1]:
+        codes,order = quadCodes(points[combos]*[1,parity])
+        ok = (np.abs(codes[:,0]+1j*codes[:,1]-(0.5+0.5j))<=0.7071+tolerance) & (np.abs(codes[:,2]+1j*codes[:,3]-(0.5+0.5j))<=0.7071+tolerance)
+        dist,hit = index['code_tree'].query(codes[ok],k=3,distance_upper_bound=tolerance)
+        stars = combos[ok][np.arange(np.sum(ok))[:,None],order[ok]]
+        for k in range(3):
+            found = np.isfinite(dist[:,k])
+            candidates += zip(dist[found,k],hit[found,k],[tuple(q) for q in stars[found]])
+    candidates.sort(key=lambda c: c[0])
+
+    if ra is not None and radius is not None:
+        quad_ra,quad_dec = index['ra'][index['quads'][:,0]],index['dec'][index['quads'][:,0]]
+        candidates = [c for c in candidates if angularSeparation(ra,dec,quad_ra[c[1]],quad_dec[c[1]])<=radius]
+
+    field_radius = np.hypot(nx,ny)/2.
+    for dist,quad,stars in candidates[:max_tries]:
+        members = index['quads'][quad]
+        cards = fitWCS(points[list(stars),0],points[list(stars),1],index['ra'][members],index['dec'][members],
+                       index['ra'][members[0]],index['dec'][members[0]])
+
+        # check the other index stars in the field land on detections
+        scale = np.sqrt(abs(cards['CD1_1']*cards['CD2_2']-cards['CD1_2']*cards['CD2_1'])) # degrees per pixel
+        ra_c,dec_c = pixelToSky(cards,(nx+1)/2.,(ny+1)/2.)
+        chord = 2*np.sin(np.radians(field_radius*scale)/2)
+        nearby = np.array(index['star_tree'].query_ball_point(unitVectors(ra_c,dec_c)[0],chord),dtype=int)
+        if len(nearby)<6:
+            continue
+        px,py = skyToPixel(cards,index['ra'][nearby],index['dec'][nearby])
+        inside = (px>=0.5) & (px<=nx+0.5) & (py>=0.5) & (py<=ny+0.5)
+        d,nearest = detections.query(np.column_stack((px,py))[inside],distance_upper_bound=max(3.0,0.01*field_radius))
+        matched = np.isfinite(d)
+        if np.sum(matched)<max(6,0.25*np.sum(inside)):
+            continue
+
+        # refine with every matched star, on the tangent plane at the center of the image
+        for j in range(2):
+            cards = fitWCS(x[nearest[matched]],y[nearest[matched]],index['ra'][nearby[inside]][matched],index['dec'][nearby[inside]][matched],ra_c,dec_c)
+            ra_c,dec_c = pixelToSky(cards,(nx+1)/2.,(ny+1)/2.)
+            px,py = skyToPixel(cards,index['ra'][nearby],index['dec'][nearby])
+            inside = (px>=0.5) & (px<=nx+0.5) & (py>=0.5) & (py<=ny+0.5)
+            d,nearest = detections.query(np.column_stack((px,py))[inside],distance_upper_bound=max(3.0,0.01*field_radius))
+            matched = np.isfinite(d)
+        cards['PLTSTARS'] = int(np.sum(matched))
+        return cards
+    return None
+
+
+#####################################################################################################################################################
+### source detection helper functions
+#####################################################################################################################################################
+
+def extractTile(job):
+    '''
+    Internal function.
+    Runs sep background estimation and extraction on one tile of the image, job = (tile,thresh,minarea,origin,core).
+    origin = (y0,x0) is where the tile (including its overlap) starts in the image and core = (y0,y1,x0,x1) is the part of
+    the image this tile is responsible for. Returns the objects with centroids inside the core, in full-image pixel coordinates.
+    '''
+    tile,thresh,minarea,origin,core = job
+    bkg = sep.Background(tile)
+    bkg_rms = bkg.rms()
+    bkg.subfrom(tile) # extractTiled gives every tile its own copy, so we can subtract in place
+    objects = sep.extract(tile, thresh, err=bkg_rms, minarea=minarea)
+
+    # shift pixel positions into full-image coordinates
+    for key in ['x','xmin','xmax','xpeak','xcpeak']:
+        objects[key] += origin[1]
+    for key in ['y','ymin','ymax','ypeak','ycpeak']:
+        objects[key] += origin[0]
+
+    # keep only the objects this tile is responsible for, so objects in the overlap are not counted twice
+    inside = (objects['y']>=core[0]) & (objects['y']<core[1]) & (objects['x']>=core[2]) & (objects['x']<core[3])
+    return objects[inside]
+
+
+def extractTiled(img,thresh,minarea,tiles,overlap,threads,processes=False):
+    '''
+    Internal function.
+    Splits the image into tiles[0] x tiles[1] (x by y) tiles that overlap by at least overlap pixels, runs background
+    estimation and extraction on each tile in a pool of threads, then merges the catalogs.
+    Threads only run in parallel with a sep that releases the GIL (sep 1.1 and later), with processes=True a pool of
+    processes is used instead, which works with any sep at the cost of sending each tile to its process.
+    Tile edges and overlaps are multiples of sep's 64 pixel background mesh, so each tile's mesh lines up with the one
+    the whole image would use.
+    '''
+    ny,nx = np.shape(img)
+    mesh = 64
+    overlap = int(math.ceil(float(overlap)/mesh))*mesh
+    x_edges = np.unique(np.r_[0,(np.round(np.arange(1,tiles[0])*nx/float(tiles[0])/mesh).astype(int)*mesh).clip(0,nx),nx])
+    y_edges = np.unique(np.r_[0,(np.round(np.arange(1,tiles[1])*ny/float(tiles[1])/mesh).astype(int)*mesh).clip(0,ny),ny])
+
+    jobs = []
+    for j in range(len(y_edges)-1):
+        for i in range(len(x_edges)-1):
+            core = (y_edges[j],y_edges[j+1],x_edges[i],x_edges[i+1])
+            y0,y1,x0,x1 = max(core[0]-overlap,0),min(core[1]+overlap,ny),max(core[2]-overlap,0),min(core[3]+overlap,nx)
+            # always a copy (a full-width tile would otherwise be a view of img), contiguous as sep needs, and the tile's own
+            # so extractTile can subtract the background in place
+            jobs.append((np.array(img[y0:y1,x0:x1],dtype='<f4',copy=True),thresh,minarea,(y0,x0),core))
+
+    if processes:
+        pool = Pool(threads)
+    else:
+        pool = ThreadPool(threads)
+    try:
+        catalogs = pool.map(extractTile,jobs)
+    finally:
+        pool.close()
+        pool.join()
+
+    objects = np.concatenate(catalogs)
+    return objects[np.lexsort((objects['x'],objects['y']))]
+
+
+
+def extractCoarse(img,thresh,minarea,factor):
+    '''
+    Internal function.
+    Coarse-to-fine detection: detects sources on a factor x factor block-averaged copy of the image, then refines each
+    centroid with sep's windowed positions on the full resolution image. The background mesh and minimum area are scaled
+    by the binning so they cover the same part of the sky as full resolution detection does.
+    Returns the objects in full resolution pixels: positions, sizes, moments and fluxes (a binned pixel is the mean of
+    factor x factor pixels) are scaled back up. peak and cpeak stay the brightest block mean, which is in counts per pixel
+    already but smoothed over the block, so they are lower than the full resolution peak.
+    '''
+    ny,nx = np.shape(img)
+    cy,cx = ny//factor*factor,nx//factor*factor
+    binned = img[:cy,:cx].reshape(cy//factor,factor,cx//factor,factor).mean(axis=3).mean(axis=1).astype('<f4')
+
+    mesh = max(64//factor,8)
+    bkg = sep.Background(binned,bw=mesh,bh=mesh)
+    bkg_rms = bkg.rms()
+    back = bkg.back()
+    bkg.subfrom(binned)
+    objects = sep.extract(binned, thresh, err=bkg_rms, minarea=max(minarea/(factor*factor),1))
+
+    # scale everything back up to full resolution pixels
+    for key in ['x','y','xpeak','ypeak','xcpeak','ycpeak']:
+        objects[key] = objects[key]*factor+(factor-1)/2.
+    for key in ['xmin','ymin']:
+        objects[key] = objects[key]*factor
+    for key in ['xmax','ymax']:
+        objects[key] = objects[key]*factor+factor-1
+    for key in ['a','b']:
+        objects[key] = objects[key]*factor
+    for key in ['npix','tnpix','flux','cflux','x2','y2','xy','errx2','erry2','errxy']:
+        objects[key] = objects[key]*factor*factor
+    for key in ['cxx','cyy','cxy']:
+        objects[key] = objects[key]/(factor*factor)
+
+    # refine the centroids with windowed positions on the full resolution image, minus the (upsampled) coarse background
+    back = np.repeat(np.repeat(back,factor,axis=0),factor,axis=1)
+    back = np.pad(back,((0,ny-cy),(0,nx-cx)),mode='edge')
+    data = img-back
+    sig = np.clip(np.sqrt(objects['a']*objects['b']),1.0,None)
+    xwin,ywin,flag = sep.winpos(data,objects['x'],objects['y'],sig)
+    refined = (flag==0) & np.isfinite(xwin) & np.isfinite(ywin)
+    objects['x'][refined] = xwin[refined]
+    objects['y'][refined] = ywin[refined]
+    return objects
+
+
+#####################################################################################################################################################
+### stacking helper functions
+#####################################################################################################################################################
+
+def stackTransforms(headers,shape,grid=5):
+    '''
+    Internal function.
+    Fits an affine transform from the pixel grid of the first header to the pixels of every header (including the first),
+    through a grid x grid set of WCS control points spread over the image.
+    Returns a list of 3x2 matrices T such that [x,y,1].dot(T) gives the frame's (x,y).
+    '''
+    ny,nx = shape
+    gx,gy = np.meshgrid(np.linspace(0,nx-1,grid),np.linspace(0,ny-1,grid))
+    gx,gy = gx.ravel(),gy.ravel()
+    ra,dec = wcs.WCS(headers[0]).all_pix2world(gx,gy,0)
+    design = np.column_stack((gx,gy,np.ones(len(gx))))
+    transforms = []
+    for h in headers:
+        fx,fy = wcs.WCS(h).all_world2pix(ra,dec,0)
+        transforms.append(np.linalg.lstsq(design,np.column_stack((fx,fy)),rcond=None)[0])
+    return transforms
+
+
+def resampleRows(total,count,data,T,r0,r1,nx):
+    '''
+    Internal function.
+    Adds frame data, bilinearly resampled onto rows r0 to r1 of the stack grid through the transform T (see
+    stackTransforms()), to the flattened total and count arrays for those rows.
+    '''
+    yy,xx = np.mgrid[r0:r1,0:nx]
+    fx,fy = np.column_stack((xx.ravel(),yy.ravel(),np.ones(xx.size))).dot(T).T
+    x0,y0 = np.floor(fx).astype(int),np.floor(fy).astype(int)
+    inside = np.nonzero((x0>=0) & (x0<np.shape(data)[1]-1) & (y0>=0) & (y0<np.shape(data)[0]-1))[0]
+    x0,y0,dx,dy = x0[inside],y0[inside],(fx-np.floor(fx))[inside],(fy-np.floor(fy))[inside]
+    total[inside] += (data[y0,x0]*(1-dx)*(1-dy) + data[y0,x0+1]*dx*(1-dy) +
+                      data[y0+1,x0]*(1-dx)*dy + data[y0+1,x0+1]*dx*dy)
+    count[inside] += 1
+
+
+def stackFrames(filenames,rows=256):
+    '''
+    Internal function.
+    Co-adds calibrated frames of one field on the pixel grid of the first frame, registering each through its header WCS.
+    For plain files the output is built a block of rows at a time: each frame is bilinearly resampled for those rows
+    straight from its memory-mapped file, so memory use is the output image plus one block per frame rather than every
+    frame at once. Tile-compressed frames can't be memory mapped (and astropy decompresses a whole frame at a time), so
+    then the frames are decompressed one at a time and added to running sums over the whole image, which keeps memory at
+    the sums plus one frame however many frames there are.
+    Each pixel is the mean of the frames covering it times the number of frames, so the stack has the counts (and noise)
+    of the summed exposure everywhere, even near the edges. Pixels no frame covers are set to the median of the stack.
+    Returns the header (of the first frame, with the combined DATE-OBS and EXPTIME) and the stacked image.
+    '''
+    headers,compressed = [],False
+    for name in filenames:
+        with fits.open(name) as hdulist:
+            hdu = imageHDU(hdulist)
+            headers.append(hdu.header.copy())
+            compressed = compressed or isinstance(hdu,fits.CompImageHDU)
+    ny,nx = headers[0]['NAXIS2'],headers[0]['NAXIS1']
+    transforms = stackTransforms(headers,(ny,nx))
+
+    stack = np.empty((ny,nx),dtype='<f4')
+    if not compressed:
+        hdulists = [fits.open(name,memmap=True) for name in filenames]
+        try:
+            frames = [imageHDU(hdulist).data for hdulist in hdulists]
+            for r0 in range(0,ny,rows):
+                r1 = min(r0+rows,ny)
+                total = np.zeros((r1-r0)*nx)
+                count = np.zeros((r1-r0)*nx)
+                for data,T in zip(frames,transforms):
+                    resampleRows(total,count,data,T,r0,r1,nx)
+                with np.errstate(invalid='ignore',divide='ignore'):
+                    stack[r0:r1] = (len(frames)*total/count).reshape(r1-r0,nx)
+        finally:
+            for hdulist in hdulists:
+                hdulist.close()
+    else:
+        total = np.zeros(ny*nx)
+        count = np.zeros(ny*nx,dtype='<u2')
+        for name,T in zip(filenames,transforms):
+            with fits.open(name) as hdulist: # closed (and the decompressed frame freed) before the next frame
+                data = imageHDU(hdulist).data
+                for r0 in range(0,ny,rows):
+                    r1 = min(r0+rows,ny)
+                    resampleRows(total[r0*nx:r1*nx],count[r0*nx:r1*nx],data,T,r0,r1,nx)
+                del data
+        with np.errstate(invalid='ignore',divide='ignore'):
+            stack[:] = (len(filenames)*total/count).reshape(ny,nx)
+        del total,count
+
+    empty = ~np.isfinite(stack)
+    if np.any(empty):
+        stack[empty] = np.median(stack[~empty])
+
+    h = headers[0].copy()
+    times = [datetime.strptime(hdr['DATE-OBS'],'%Y-%m-%dT%H:%M:%S.%f') for hdr in headers]
+    h['DATE-OBS'] = (min(times)+(max(times)-min(times))/2).strftime('%Y-%m-%dT%H:%M:%S.%f') # middle of the stack
+    if 'EXPTIME' in h:
+        h['EXPTIME'] = sum([float(hdr['EXPTIME']) for hdr in headers])
+    h['NCOMBINE'] = (len(filenames),'number of frames in the stack')
+    for name in filenames:
+        h.add_history('Stacked '+os.path.basename(name))
+    return h,stack
+
 
 #####################################################################################################################################################
 ### per image operations contained withing Field object
@@ -610,30 +2111,89 @@ class Field:
         self.uncalibrated_path = 'ArchSky/' # path where uncalibrated images are found
         self.path_to_masters = 'MasterCal/' # path where masters are found
         self.max_temp = -3.0 # maximum temp for calibration
+        self.calibration_rows = 256 # rows calibrated at a time in the in-place float32 kernel, None for the whole frame at once
+        self.nearest_masters = True # calibrate with the masters closest in time to each image, including archived ones, instead of the current ones
+        self.write_behind = True # write calibrated images in a background thread while the next image is processed (see flushWrites())
         self.isCalibrated = False # variable defining whether the image is calibrated yet
         self.aperture_size = 30.0 # aperture size for photometry
-        self.cutoff = True # cutoff outliers from annulus for photometry 
-        self.counter = 0 # counter for how many images we have processed in this run 
+        self.aperture_sizes = [] # extra aperture sizes measured in the same pass and written to apertures.csv (curve of growth)
+        self.cutoff = True # cutoff outliers from annulus for photometry
+        self.match_radius = 3.0 # radius in arcseconds for matching detected objects to the catalog
+        self.forced = False # forced photometry at each field's reference star positions instead of detecting sources in every image
+        self.detect_cadence = 20 # with forced photometry, still run detection on every Nth image of a field to find new sources
+        self.reference_path = 'References/' # where the reference source list for each field is kept
+        self.forced_counts = {} # images of each field seen this run, for the detection cadence
+        self.use_src = False # use the .SRC source list Image Link saves next to the image when there is one, instead of running sep (check src_columns and src_origin with benchmark.py src first)
+        self.src_columns = (0,1) # columns of the .SRC file holding the x and y pixel positions
+        self.src_origin = 0 # pixel origin of the .SRC positions (0 like sep, or 1 like FITS)
+        self.tiles = (1,1) # number of tiles (x,y) to split the image into for source detection, e.g. (2,2) for 1x1 frames
+        self.tile_overlap = 256 # overlap between tiles in binning 1x1 pixels
+        self.threads = 4 # number of threads used for tiled source detection
+        self.tile_processes = False # use processes instead of threads for tiled detection (for versions of sep that hold the GIL)
+        self.detect_binning = 1 # detect sources on a 2x2 or 4x4 block-averaged copy of the image and refine at full resolution (see Completeness())
+        self.quality_check = False # measure sky, noise, star count and seeing on a subsample and skip photometry for frames that fail (thresholds below are untuned)
+        self.min_stars = 5 # fewest stars in the central quality check region (clouds)
+        self.max_fwhm = 25.0 # largest median FWHM in pixels at binning 1x1 (defocused or bad seeing)
+        self.max_elongation = 2.0 # largest median a/b of the stars (trailing)
+        self.max_sky = None # brightest sky level in counts (twilight, moon), None for no limit
+        self.quality = None # quality metrics for the current image
+        self.save_cutouts = False # save a cutout around every measured star to a per-night cube in cutout_path (see rePhotometry())
+        self.cutout_path = 'Cutouts/' # where the per-night cutout files are written
+        self.cutout_radius = 90.0 # half-size of the cutouts in binning 1x1 pixels, re-photometry works for annulus outer radii up to this
+        self.cache_products = True # keep detections and world coordinates in a .npz next to the calibrated image and reuse them while the image and parameters are unchanged
+        self.stack = False # co-add frames of the same field and filter and run photometry on the stacks instead of every frame (see Stack())
+        self.stack_window = 30.0 # length in minutes of the time bins frames are stacked in
+        self.stack_min_frames = 3 # smallest number of frames worth stacking, smaller groups are measured frame by frame
+        self.stack_path = 'Stacks/' # where stacks are written, in a folder per night
+        self.plate_solve = True # plate solve images without WCS with the local quad index, if buildQuadIndex() has made one
+        self.solve_radius = 2.0 # search radius in degrees around the header pointing when plate solving
+        self.counter = 0 # counter for how many images we have processed in this run
+        self.apertures = None # multi-aperture measurements for the current image, only used if aperture_sizes is set 
     
     #####################################################################################################################################################
     ### open a fits file 
     #####################################################################################################################################################
     
-    def openFits(self,filename,calibrated=False,inPipeline=False):
+    def openFits(self,filename,calibrated=False,inPipeline=False,header_only=False):
+        '''
+        Opens an image, setting self.hdr and self.img (as native float32 for SourceExtractor (sep)).
+        With header_only, only the header is read and self.img is None until loadImage(), so Reduce() can reject
+        frames from the header without reading their pixels.
+        '''
         self.filename = filename
+        self.content_hash = None # hash of the image data, computed when the product cache needs it
         if not inPipeline: # portable functionality if we aren't running this command from inside the pipeline
             self.uncalibrated_path = '' 
             self.calibrated_path = ''
         if not calibrated: # if it hasnt been calibrated we need the uncalibrated path 
-            with fits.open(self.uncalibrated_path+self.filename) as hdulist:
-                self.hdr = hdulist[0].header
-                img = hdulist[0].data
-                self.img = np.array(img,dtype='<f4') # change dtype because of SourceExtractor (sep) 
+            self.image_file = self.uncalibrated_path+self.filename
         else: # otherwise we need the calibrated path
-            with fits.open(self.calibrated_path+self.filename.replace('.fits','_c.fits')) as hdulist:
-                self.hdr = hdulist[0].header
-                img = hdulist[0].data
-                self.img = np.array(img,dtype='<f4')
+            self.image_file = self.calibrated_path+self.filename.replace('.fits','_c.fits')
+        if header_only:
+            self.hdr = imageHeader(self.image_file)
+            self.img = None
+        else:
+            self.hdr,self.img = readFits(self.image_file)
+
+    def loadImage(self):
+        '''
+        Reads the pixels of an image opened with header_only=True.
+        '''
+        if self.img is None:
+            self.img = readFits(self.image_file)[1]
+            self.hdr.remove('BSCALE',ignore_missing=True) # already applied to self.img
+            self.hdr.remove('BZERO',ignore_missing=True)
+        return self.img
+
+    def skipImage(self):
+        '''
+        Internal function.
+        Counts the pixel data of a frame rejected from its header that was never read, for the status email.
+        '''
+        global skipped_frames,skipped_bytes
+        if self.img is None:
+            skipped_frames += 1
+            skipped_bytes += abs(self.hdr.get('BITPIX',16))//8*self.hdr.get('NAXIS1',0)*self.hdr.get('NAXIS2',0)
 
     
     #####################################################################################################################################################
@@ -646,9 +2206,17 @@ class Field:
                 os.makedirs(self.calibrated_path) # make a directory if there isnt one
         else:
             self.calibrated_path = ''
-        fits.writeto(self.calibrated_path+filename.replace(".fit","_c.fit"),data,h,overwrite=True)
-        prnt(self.filename,'Wrote file to '+self.calibrated_path)
+        name = self.calibrated_path+filename.replace(".fit","_c.fit")
+        if self.write_behind:
+            writeBehind(name,data,h.copy()) # copy the header so it can still be changed here, e.g. when plate solving
+            prnt(self.filename,'Writing file to '+self.calibrated_path)
+        else:
+            writeImage(name,data,h,overwrite=True)
+            prnt(self.filename,'Wrote file to '+self.calibrated_path)
         self.isCalibrated = True # now its calibrated so we change this variable to True
+        self.hdr,self.img = h,data # keep the calibrated image so Extract() doesn't have to read it back
+        self.image_file = name
+        self.content_hash = None
     
 
     #####################################################################################################################################################
@@ -666,12 +2234,31 @@ class Field:
             erlog.write(description)
 
 
+    #####################################################################################################################################################
+    ### choose the master calibration files for an image
+    #####################################################################################################################################################
+
+    def masterFilename(self,typ,h):
+        '''
+        Internal function.
+        Filename of the bias, dark or flat master (typ) to calibrate the image with header h: with nearest_masters, the
+        valid one closest in time from the master library (see selectMaster()), otherwise the current one in path_to_masters.
+        '''
+        if self.nearest_masters:
+            filename = selectMaster(typ,h)
+            if filename is not None:
+                return filename
+        if typ=='flat':
+            return self.path_to_masters+'flat_master_'+h['FILTER']+'.fit'
+        return self.path_to_masters+typ+'_master.fit'
+
+
     #####################################################################################################################################################
     ### check if image needs to be calibrated
     #####################################################################################################################################################
 
-    def checkCalibration(self,h,image): # check to see whether or not we need to calibrate the file
-        if np.size(image)==8487264 or np.size(image)==2121816 or np.size(image)==942748: # sizes for our three binning factors that we will use
+    def checkCalibration(self,h): # check from the header alone whether or not we need to calibrate the file
+        if frameWindow(h) is not None: # full frames or subframes at the binnings we have masters for
             if h['CCD-TEMP']<=self.max_temp: 
                 if h.get('CALSTAT',default=0)==0: 
                     return True # True means we calibrate
@@ -760,7 +2347,7 @@ class Field:
         if inPipeline:
             header('Calibration & Source Extraction',count=(self.counter,len(self.list_of_files)))
         
-        light_h,light = self.hdr,self.img # bring up the hdr and image
+        light_h = self.hdr # bring up the hdr, the pixels are only read once we know we need them
         prnt(self.filename,'Successfully opened %s image in %s' % (light_h['FILTER'],self.uncalibrated_path),filename=True)
         self.path_to_masters = 'MasterCal/binning%s/' % str(light_h['XBINNING']) # search for calibration files in binning-specific folder
 
@@ -772,12 +2359,45 @@ class Field:
             self.narrowBand = False
 
 
+        #####################################################################################################################################################
+        ### decide what to do from the header alone
+
+        calibration = self.checkCalibration(light_h)
+
+        # if its temperature is too high
+        if calibration=='Temp': 
+            self.writeError('     in Reduce: Rejected calibration, taken at %s degrees C' % light_h['CCD-TEMP'])
+            prnt(self.filename,'Image taken at > '+str(self.max_temp)+' degrees C')
+            self.skipImage()
+            sleep(4)
+            return
+        
+        # if the size is incorrect, either because the subframe doesn't fit on the sensor or because we were binning at something other than 1x1, 2x2, or 3x3
+        elif calibration=='Size':
+            self.writeError('     in Reduce: Rejected calibration, captured with non-standard binning or size')
+            prnt(self.filename,'Rejected calibration, captured with non-standard binning or size')
+            self.skipImage()
+            sleep(4)
+            return
+
+        # if it was already calibrated
+        elif calibration=='Redundant': 
+            self.writeError('     in Reduce: Attempted redundant calibration')
+            prnt(self.filename,'Image already calibrated')
+            self.saveFits(light_h,self.loadImage(),self.filename,inPipeline=inPipeline) # still save the file because we can still use it
+            return
+
+        elif calibration not in [True,'OnlyDark']: # unknown CALSTAT
+            self.skipImage()
+            return
+
+
         #####################################################################################################################################################
         ### open the bias master
 
-        bias_filename = self.path_to_masters+'bias_master.fit'
+        bias_filename = self.masterFilename('bias',light_h)
         try: 
-            bias_fits = fits.open(bias_filename) 
+            bias_h,bias = loadMaster(bias_filename) 
             prnt(self.filename,'Successfully opened bias master %s' % bias_filename)
         except: # if you encounter error
             prnt(self.filename,'Failed to open bias master %s' % bias_filename)
@@ -785,8 +2405,6 @@ class Field:
             self.writeError('     in Reduce: Missing bias master %s. Data reduction halted' % bias_filename)
             return # exit the program since you can't calibrate files without a bias frame
 
-        bias_h = bias_fits[0].header # split into header and data
-        bias = bias_fits[0].data
         bias_date = bias_h['DATE-OBS']
         bias_date = bias_date[0:4] + bias_date[5:7] + bias_date[8:10]
 
@@ -794,9 +2412,9 @@ class Field:
         #####################################################################################################################################################
         ### open the dark master
 
-        dark_filename = self.path_to_masters+'dark_master.fit'
+        dark_filename = self.masterFilename('dark',light_h)
         try:
-            dark_fits = fits.open(dark_filename) 
+            dark_h,dark = loadMaster(dark_filename) 
             prnt(self.filename,'Successfully opened dark master %s' % dark_filename)
         except:
             prnt(self.filename,'Failed to open dark master %s' % dark_filename)
@@ -804,8 +2422,6 @@ class Field:
             self.writeError('     in Reduce: Missing dark master %s. Data reduction halted' % dark_filename)
             return
 
-        dark_h = dark_fits[0].header
-        dark = dark_fits[0].data
         dark_date = dark_h['DATE-OBS']
         dark_date = dark_date[0:4] + dark_date[5:7] + dark_date[8:10]
         
@@ -815,9 +2431,9 @@ class Field:
         #####################################################################################################################################################
         ### open filter-specific flat field
 
-        flat_filename = self.path_to_masters+'flat_master_'+light_h['FILTER']+'.fit'
+        flat_filename = self.masterFilename('flat',light_h)
         try: 
-            flat_fits = fits.open(flat_filename) 
+            flat_h,flat = loadMaster(flat_filename) 
             prnt(self.filename,'Successfully opened '+flat_filename)
         except:
             prnt(self.filename,'Failed to open flat master %s' % flat_filename)
@@ -825,8 +2441,6 @@ class Field:
             self.writeError('     in Reduce: Missing %s flat master in %s. Data reduction halted' % (light_h['FILTER'],self.path_to_masters))
             return
         
-        flat_h = flat_fits[0].header
-        flat = flat_fits[0].data
         flat_date = flat_h['DATE-OBS']
         flat_date = flat_date[0:4] + flat_date[5:7] + flat_date[8:10]
 
@@ -834,48 +2448,38 @@ class Field:
         #####################################################################################################################################################
         ### perform the actual data reduction
 
+        light = self.loadImage()
+        window = frameWindow(light_h) # the part of the full frame this image covers, to calibrate subframes with views of the masters
+        full_frame = (sensor_shape[0]//light_h['XBINNING'],sensor_shape[1]//light_h['XBINNING'])
+        for master_filename,master in [(bias_filename,bias),(dark_filename,dark),(flat_filename,flat)]:
+            if np.shape(master)!=full_frame:
+                self.writeError('     in Reduce: Master %s is %sx%s, not a full %sx%s frame. Data reduction halted' % (master_filename,np.shape(master)[1],np.shape(master)[0],full_frame[1],full_frame[0]))
+                return
+
         # if we need to calibrate the image
-        if self.checkCalibration(light_h,light)==True: 
+        if calibration==True: 
             prnt(self.filename,'Calibrating image...' )
 
-            bias_corrected_image = light - bias # subtract the bias
-            dark_corrected_image = bias_corrected_image - (exptime/dxptime) * dark # scale the dark linearly w/ exptime and subtract
-            final_image = dark_corrected_image / flat # divide by the flat field (already normalized)
+            # subtract the bias and the dark scaled to this exposure time, and divide by the flat, in one step
+            offset,inverse_flat = calibrationPlan((bias_filename,dark_filename,flat_filename),exptime,bias,flat,dark=dark,dxptime=dxptime)
+            final_image = calibrateFrame(light,offset[window],inverse_flat[window],rows=self.calibration_rows) # overwrites self.img
             
             self.writeToHeader(light_h,flat=flat_filename,bias=bias_filename,dark=dark_filename,flatdate=flat_date,biasdate=bias_date,darkdate=dark_date)
             self.saveFits(light_h, final_image,self.filename,inPipeline=inPipeline)
 
         # if we only had an auto dark
-        elif self.checkCalibration(light_h,light)=='OnlyDark': 
+        elif calibration=='OnlyDark': 
             prnt(self.filename,'Calibrating image...' )
             
-            bias_corrected_image = light - bias
-            final_image = bias_corrected_image / flat 
+            offset,inverse_flat = calibrationPlan((bias_filename,None,flat_filename),exptime,bias,flat) # bias only
+            final_image = calibrateFrame(light,offset[window],inverse_flat[window],rows=self.calibration_rows)
 
             self.writeToHeader(light_h,bias=bias_filename,flat=flat_filename,biasdate=bias_date,flatdate=flat_date)
             self.saveFits(light_h, final_image,self.filename,inPipeline=inPipeline)
-
-        # if it was already calibrated
-        elif self.checkCalibration(light_h,light)=='Redundant': 
-            self.writeError('     in Reduce: Attempted redundant calibration')
-            prnt(self.filename,'Image already calibrated')
-            self.saveFits(light_h, light,self.filename,inPipeline=inPipeline) # still save the file because we can still use it
-
-        # if its temperature is too high
-        elif self.checkCalibration(light_h,light)=='Temp': 
-            self.writeError('     in Reduce: Rejected calibration, taken at %s degrees C' % light_h['CCD-TEMP'])
-            prnt(self.filename,'Image taken at > '+str(self.max_temp)+' degrees C')
-            sleep(4)
-        
-        # if the size is incorrect, either because we used a subframe or because we were binning at something either than 1x1, 2x2, or 3x3
-        elif self.checkCalibration(light_h,light)=='Size':
-            self.writeError('     in Reduce: Rejected calibration, captured with subframe or non-standard binning')
-            prnt(self.filename,'Rejected calibration, captured with subframe or non-standard binning')
-            sleep(4)
         
-        # close the images
-        del self.hdr,self.img
-        del flat_fits,bias_fits,dark_fits
+        # close the image, unless it was calibrated and Extract() can use it from memory (the masters stay in the master cache)
+        if not self.isCalibrated:
+            del self.hdr,self.img
 
 
     #####################################################################################################################################################
@@ -889,6 +2493,38 @@ class Field:
         '''
         
         hdr,img = self.hdr,self.img
+        minarea = 120/hdr['XBINNING']/hdr['YBINNING']
+
+        # reuse the detections from an earlier run on the same image with the same parameters (the last part is bumped
+        # when the detections themselves change: 2 is coarse detections scaled to full resolution fluxes and moments)
+        key = self.cacheKey(self.imageHash(),4,minarea,self.detect_binning,tuple(self.tiles),self.tile_overlap,sep.__version__,2)
+        objects = self.loadCache('source',key)
+        if objects is not None:
+            prnt(self.filename,'Loaded %s cached detections' % len(objects))
+            return objects
+        objects = self.detectSources(img,minarea)
+        self.saveCache('source',key,objects)
+        return objects
+
+
+    def detectSources(self,img,minarea):
+        '''
+        Internal function.
+        Runs source detection with the configured method (binned, tiled or a single sep pass).
+        '''
+        hdr = self.hdr
+
+        # detect on a binned copy and refine the positions at full resolution
+        if self.detect_binning>1:
+            objects = extractCoarse(img, 4, minarea, self.detect_binning)
+            prnt(self.filename,'Source detection complete with %s objects on %sx%s binned image' % (str(len(objects)),self.detect_binning,self.detect_binning))
+            return objects
+
+        # split large frames into tiles and extract them in parallel
+        if tuple(self.tiles)!=(1,1):
+            objects = extractTiled(img, 4, minarea, self.tiles, self.tile_overlap/hdr['XBINNING'], self.threads, processes=self.tile_processes)
+            prnt(self.filename,'Source detection complete with %s objects in %sx%s tiles' % (str(len(objects)),self.tiles[0],self.tiles[1]))
+            return objects
 
         bkg = sep.Background(img) # get 2D array of background
         bkg_data = bkg.back()
@@ -897,12 +2533,150 @@ class Field:
         img = img - bkg_data # subtract background temporarily 
         
         # detect objects with a threshold of 4*bkg_rms and minimum area of 120 pixels at binning 1x1
-        objects = sep.extract(img, 4, err=bkg_rms,minarea=120/hdr['XBINNING']/hdr['YBINNING']) 
+        objects = sep.extract(img, 4, err=bkg_rms,minarea=minarea) 
 
         prnt(self.filename,'Source detection complete with %s objects' % str(len(objects)))
         return objects
 
 
+    def Quality(self,count_stars=True):
+        '''
+        Internal function.
+        Fast frame quality check run before source detection and photometry. The sky level and noise come from
+        every 4th pixel of the image, and stars are detected on the central quarter against that global sky, which
+        is much cheaper than the full background map. Metrics are kept in self.quality and appended to quality.csv.
+        With count_stars False (forced photometry, where nothing else is detected) only the sky is checked.
+        Returns True if the image passes all the thresholds.
+        '''
+        global quality_passed,quality_rejected
+        hdr,img = self.hdr,self.img
+        binning = hdr['XBINNING']
+
+        sample = img[::4,::4]
+        sky = np.median(sample)
+        rms = 1.4826*np.median(np.abs(sample-sky))
+
+        ny,nx = np.shape(img)
+        stars = np.zeros(0,dtype=[('a','<f8'),('b','<f8'),('flag','<i4')])
+        if count_stars:
+            crop = np.ascontiguousarray(img[ny//4:3*ny//4,nx//4:3*nx//4])-sky
+            try:
+                stars = sep.extract(crop, 5, err=max(rms,1e-3), minarea=120/hdr['XBINNING']/hdr['YBINNING'])
+            except Exception as e:
+                self.writeError('     in Quality: source detection failed on quality check region, '+str(e))
+            stars = stars[(stars['flag']==0) & (stars['b']>0)]
+        if len(stars)>0:
+            fwhm = 2.3548*np.median(np.sqrt((stars['a']**2+stars['b']**2)/2.))*binning
+            elongation = np.median(stars['a']/stars['b'])
+        else:
+            fwhm,elongation = np.nan,np.nan
+
+        reasons = []
+        if count_stars and len(stars)<self.min_stars:
+            reasons.append('%s stars' % len(stars))
+        if fwhm>self.max_fwhm:
+            reasons.append('FWHM %.1f' % fwhm)
+        if elongation>self.max_elongation:
+            reasons.append('elongation %.2f' % elongation)
+        if self.max_sky is not None and sky>self.max_sky:
+            reasons.append('sky %.0f' % sky)
+        passed = len(reasons)==0
+
+        self.quality = OrderedDict([('IMGNAME',self.filename),('DATE-OBS',hdr.get('DATE-OBS',default='')),('FILTER',hdr.get('FILTER',default='')),
+                                    ('SKY',round(sky,2)),('RMS',round(rms,3)),('NSTARS',len(stars) if count_stars else ''),('FWHM',round(fwhm,2)),
+                                    ('ELONG',round(elongation,3)),('PASSED',passed),('REASON',', '.join(reasons))])
+        newfile = not os.path.exists('quality.csv')
+        with open('quality.csv', 'a') as outfile:
+            writer = csv.writer(outfile)
+            if newfile:
+                writer.writerow(self.quality.keys())
+            writer.writerow(self.quality.values())
+
+        if passed:
+            quality_passed += 1
+            if count_stars:
+                prnt(self.filename,'Quality check passed: sky %.0f, rms %.1f, %s stars, FWHM %.1f, elongation %.2f' % (sky,rms,len(stars),fwhm,elongation))
+            else:
+                prnt(self.filename,'Quality check passed: sky %.0f, rms %.1f' % (sky,rms))
+        else:
+            quality_rejected += 1
+            prnt(self.filename,'Quality check failed (%s), skipping photometry...' % ', '.join(reasons),alert=True)
+            self.writeError('     Image failed quality check (%s), image skipped' % ', '.join(reasons))
+        return passed
+
+
+    def Completeness(self,radius=2.0):
+        '''
+        Reports how well coarse (detect_binning) detection reproduces full resolution detection on the current image:
+        the fraction of full resolution sources found within radius pixels, overall and for the brightest half,
+        the fraction of coarse detections with no full resolution counterpart, and the median position offset.
+        Use this on a few typical images before turning detect_binning on in the pipeline.
+        '''
+        factor = self.detect_binning
+        self.detect_binning = 1
+        try:
+            full = self.Source()
+        finally:
+            self.detect_binning = factor
+        coarse = self.Source()
+
+        if len(full)==0 or len(coarse)==0:
+            prnt(self.filename,'Completeness: %s full resolution and %s coarse detections, nothing to compare' % (len(full),len(coarse)))
+            return None
+
+        dx = full['x'][:,None]-coarse['x'][None,:]
+        dy = full['y'][:,None]-coarse['y'][None,:]
+        dist = np.sqrt(dx*dx+dy*dy)
+        found = np.min(dist,axis=1)<=radius
+        bright = full['flux']>=np.median(full['flux'])
+        spurious = np.min(dist,axis=0)>radius
+
+        report = OrderedDict([('binning',factor),('n_full',len(full)),('n_coarse',len(coarse)),
+                              ('completeness',np.mean(found)),('completeness_bright',np.mean(found[bright])),
+                              ('spurious',np.mean(spurious)),('offset',np.median(np.min(dist,axis=1)[found]) if np.any(found) else np.nan)])
+        prnt(self.filename,'Completeness at %sx%s: %.1f%% of %s sources (%.1f%% of the brightest half), %.1f%% spurious, median offset %.2f pixels' %
+             (factor,factor,100*report['completeness'],len(full),100*report['completeness_bright'],100*report['spurious'],report['offset']))
+        return report
+
+
+    def readSRC(self):
+        '''
+        Internal function.
+        Reads the .SRC source list Image Link saved alongside the uncalibrated image, if there is one.
+        Any line starting with a number is taken as a row, the x/y pixel positions come from the src_columns columns.
+        Returns None if there is no .SRC file or it cannot be read, so we fall back to sep detection.
+        '''
+        filename = self.uncalibrated_path+os.path.splitext(self.filename)[0]+'.SRC'
+        if not os.path.exists(filename):
+            return None
+
+        try:
+            with open(filename,'rb') as f:
+                content = f.read()
+            if '\x00' in content: # not a text source list
+                raise ValueError('unrecognized binary format')
+            rows = []
+            for line in content.splitlines():
+                values = line.replace(',',' ').split()
+                try:
+                    rows.append([float(v) for v in values])
+                except ValueError: # header or comment line
+                    continue
+            ncols = min([len(r) for r in rows]) if rows else 0
+            if ncols<=max(self.src_columns):
+                raise ValueError('no rows with x and y columns')
+            data = np.array([r[:ncols] for r in rows])
+        except (IOError,ValueError) as e:
+            prnt(self.filename,'Could not read %s (%s), using sep detection' % (filename,e),alert=True)
+            self.writeError('     in readSRC: Could not read %s (%s), used sep detection instead' % (filename,e))
+            return None
+
+        x = data[:,self.src_columns[0]]-self.src_origin
+        y = data[:,self.src_columns[1]]-self.src_origin
+        prnt(self.filename,'Read %s sources from %s' % (len(x),filename))
+        return makeSourceList(x,y)
+
+
     def Convert(self): 
         '''
         Internal function.
@@ -916,14 +2690,209 @@ class Field:
         except KeyError:
             return 'NOWCS'
         
+        # the transform only depends on the header and the pixel positions
+        x,y = np.asarray(self.source['x'],dtype=float),np.asarray(self.source['y'],dtype=float)
+        key = self.cacheKey(hdr.tostring(),x.tobytes(),y.tobytes())
+        world = self.loadCache('world',key)
+        if world is not None:
+            prnt(self.filename,'Loaded cached world coordinates')
+            return world
+
         w = wcs.WCS(hdr) # gets WCS matrix from the header
-        coords = zip(self.source['x'],self.source['y']) # combine x and y coords into single array
+        coords = np.column_stack((x,y)) # combine x and y coords into single array
         world = w.wcs_pix2world(coords, 1) # World Coorindate System function converts matrix in fits header to RA/Dec
 
+        self.saveCache('world',key,world)
         prnt(self.filename,'Converted source coordinates from pixel to world')
         return world
 
 
+    #####################################################################################################################################################
+    ### cache of intermediate products (detections, world coordinates) kept next to the calibrated image
+    #####################################################################################################################################################
+
+    def imageHash(self):
+        '''
+        Internal function.
+        Returns a hash of the image data, computed once per opened image.
+        '''
+        if getattr(self,'content_hash',None) is None:
+            self.content_hash = hashlib.sha1(np.ascontiguousarray(self.img).view(np.uint8)).hexdigest()
+        return self.content_hash
+
+
+    def cacheKey(self,*parts):
+        '''
+        Internal function.
+        Combines the inputs and parameters of a stage into a single key, so any change to them misses the cache.
+        '''
+        key = hashlib.sha1()
+        for part in parts:
+            key.update(part if isinstance(part,bytes) else repr(part).encode())
+        return key.hexdigest()
+
+
+    def cachePath(self):
+        return self.calibrated_path+os.path.splitext(self.filename)[0]+'_c.npz'
+
+
+    def loadCache(self,stage,key):
+        '''
+        Internal function.
+        Returns the cached result of a stage for this image, or None if there is none or it was made from different inputs.
+        '''
+        if not self.cache_products or not os.path.exists(self.cachePath()):
+            return None
+        try:
+            with np.load(self.cachePath()) as cache:
+                if stage+'_key' in cache.files and str(cache[stage+'_key'])==key:
+                    return cache[stage]
+        except Exception as e:
+            self.writeError('     in loadCache: could not read %s, ignoring it (%s)' % (self.cachePath(),str(e)))
+        return None
+
+
+    def saveCache(self,stage,key,value):
+        '''
+        Internal function.
+        Stores the result of a stage in the image's .npz sidecar, keeping the other stages' entries.
+        '''
+        if not self.cache_products:
+            return
+        name = self.cachePath()
+        entries = {}
+        if os.path.exists(name):
+            try:
+                with np.load(name) as cache:
+                    entries = dict((k,cache[k]) for k in cache.files)
+            except Exception:
+                entries = {}
+        entries[stage] = value
+        entries[stage+'_key'] = np.array(key)
+        try:
+            np.savez(name+'.tmp.npz',**entries)
+            os.rename(name+'.tmp.npz',name) # so a crash never leaves a half written cache
+        except (IOError,OSError) as e:
+            self.writeError('     in saveCache: could not write %s (%s)' % (name,str(e)))
+
+
+    def Solve(self):
+        '''
+        Plate solves the current image with the local quad index (see buildQuadIndex()) when Image Link didn't write a WCS,
+        using the sep detections and the telescope pointing in the header (OBJCTRA/OBJCTDEC) to narrow the search.
+        Writes the WCS to the header, and to the calibrated file if there is one, and returns True if it solved.
+        '''
+        hdr = self.hdr
+        if not os.path.exists(os.path.join(quad_index_path,'index.npz')):
+            return False
+        objects = self.source if 'flux' in self.source.dtype.names else self.Source()
+        objects = objects[np.argsort(-objects['flux'])]
+
+        ra,dec = None,None
+        try:
+            ra = coord.Angle(hdr['OBJCTRA'],unit=u.hourangle).degree
+            dec = coord.Angle(hdr['OBJCTDEC'],unit=u.deg).degree
+        except (KeyError,ValueError):
+            pass
+
+        t0 = datetime.utcnow()
+        cards = solveField(objects['x']+1,objects['y']+1,np.shape(self.img),ra=ra,dec=dec,radius=self.solve_radius if ra is not None else None)
+        seconds = (datetime.utcnow()-t0).total_seconds()
+        if cards is None:
+            prnt(self.filename,'Plate solve failed after %.2f seconds' % seconds,alert=True)
+            self.writeError('     in Solve: no plate solution found')
+            return False
+
+        stale = ['CDELT1','CDELT2','CROTA1','CROTA2','PC1_1','PC1_2','PC2_1','PC2_2']
+        for key in stale:
+            hdr.remove(key,ignore_missing=True)
+        for key in cards:
+            hdr[key] = cards[key]
+        hdr['WCSVER'] = ('PIPELINE','WCS from the pipeline plate solver')
+        prnt(self.filename,'Plate solved with %s stars in %.2f seconds' % (cards['PLTSTARS'],seconds))
+
+        name = self.calibrated_path+self.filename.replace('.fits','_c.fits')
+        flushWrites() # the calibrated image may still be waiting to be written
+        if os.path.exists(name):
+            with fits.open(name,mode='update') as hdulist:
+                file_hdr = imageHDU(hdulist).header # edited in place, which also works for compressed images
+                for key in stale:
+                    file_hdr.remove(key,ignore_missing=True)
+                for key in list(cards)+['WCSVER']:
+                    file_hdr[key] = (hdr[key],hdr.comments[key])
+        return True
+
+
+    def fieldName(self,hdr=None,filename=None):
+        '''
+        Internal function.
+        Name of the field the image is pointed at, from the OBJECT header keyword or else the start of the filename.
+        Uses the current image unless another header and filename are given.
+        '''
+        hdr = self.hdr if hdr is None else hdr
+        filename = self.filename if filename is None else filename
+        name = str(hdr.get('OBJECT',default='')).strip()
+        if name=='':
+            name = filename.split('_Light')[0]
+        return name.replace(' ','_').replace('/','_')
+
+
+    def Forced(self):
+        '''
+        Internal function.
+        Projects the field's reference source list into the image through the header WCS for forced photometry.
+        Returns None when we should run detection instead: there is no reference list (with confirmed sources) or WCS
+        yet, or it is this field's turn to run detection (every detect_cadence images) to find new sources.
+        '''
+        name = self.fieldName()
+        count = self.forced_counts.get(name,0)
+        self.forced_counts[name] = count+1
+        reference = self.reference_path+name+'.npz'
+        if count % self.detect_cadence==0 or not os.path.exists(reference) or 'WCSVER' not in self.hdr:
+            return None
+
+        with np.load(reference) as ref:
+            ra,dec = ref['ra'],ref['dec']
+        if len(ra)==0: # nothing seen twice yet
+            return None
+        w = wcs.WCS(self.hdr)
+        x,y = w.wcs_world2pix(ra,dec,1) # same pixel convention Convert() uses
+        ny,nx = np.shape(self.img)
+        inside = (x>=0) & (x<=nx-1) & (y>=0) & (y<=ny-1)
+
+        prnt(self.filename,'Forced photometry at %s reference positions for field %s' % (np.sum(inside),name))
+        return makeSourceList(x[inside],y[inside])
+
+
+    def updateReference(self):
+        '''
+        Internal function.
+        Adds newly detected sources to the field's reference list. A source (any detection not within match_radius of a
+        reference position) is first kept as a candidate, and only joins the reference list if the next detection pass
+        of the field finds it again; candidates that don't come back (cosmic rays, satellites, noise peaks) are dropped.
+        '''
+        name = self.fieldName()
+        reference = self.reference_path+name+'.npz'
+        ra,dec = np.asarray(self.world)[:,0],np.asarray(self.world)[:,1]
+        if os.path.exists(reference):
+            with np.load(reference) as ref:
+                ref_ra,ref_dec = ref['ra'],ref['dec']
+                cand_ra,cand_dec = (ref['cand_ra'],ref['cand_dec']) if 'cand_ra' in ref.files else (np.zeros(0),np.zeros(0))
+            match,dif = crossMatch(ra,dec,ref_ra,ref_dec,self.match_radius)
+            ra,dec = ra[match<0],dec[match<0]
+            match,dif = crossMatch(ra,dec,cand_ra,cand_dec,self.match_radius)
+            seen = match>=0 # candidates from the last detection pass found again
+            ref_ra,ref_dec = np.concatenate([ref_ra,ra[seen]]),np.concatenate([ref_dec,dec[seen]])
+            cand_ra,cand_dec = ra[~seen],dec[~seen]
+            prnt(self.filename,'Added %s new sources to the reference list for field %s (%s candidates)' % (np.sum(seen),name,len(cand_ra)))
+        else:
+            if not os.path.exists(self.reference_path):
+                os.makedirs(self.reference_path)
+            ref_ra,ref_dec,cand_ra,cand_dec = np.zeros(0),np.zeros(0),ra,dec
+            prnt(self.filename,'Started reference list for field %s with %s candidate sources' % (name,len(ra)))
+        np.savez(reference,ra=ref_ra,dec=ref_dec,cand_ra=cand_ra,cand_dec=cand_dec)
+
+
     def Photometry(self): 
         hdr,img = self.hdr,self.img
         egain = float(hdr['EGAIN'])
@@ -933,91 +2902,88 @@ class Field:
         
         prnt(self.filename,'Performing aperture photometry...')
 
-        indices_to_remove = [] # for removing bad data
-        fluxes,fluxerrs = [],[]
-        
         # define aperture size relative to binning
         aperture_size = float(self.aperture_size) / float(hdr['XBINNING'])
         r_in = 1.5*aperture_size
-        r_out = 2.0*aperture_size            
-
-        # loop through each source and get flux within aperture
-        for i in range(len(self.source)):
-            # manually measure annulus values
-            annulus_values = []
-            for dx in range(-int(r_out),int(r_out)):
-                for dy in range(-int(r_out),int(r_out)): # two for loops makes a square with sides 2*r_out
-                    if np.sqrt(dx*dx+dy*dy)>r_in and np.sqrt(dx*dx+dy*dy)<r_out: # if the distance from center is within annulus boundaries
-                        x_index = int(self.source['x'][i]+dx) 
-                        y_index = int(self.source['y'][i]+dy)
-                        try:
-                            annulus_values.append(img[y_index,x_index])
-                        except IndexError:
-                            pass
-            
-            ## cutoff outliers from the annulus
-            if self.cutoff:
-                for j in range(3): # iteratively remove outliers
-                    std = np.std(annulus_values)
-                    mean = np.mean(annulus_values)
-                    annulus_values = [a for a in annulus_values if a<=mean+3*std] # if outliers are above 3 std deviations 
-            
-            bkg_mean = np.mean(annulus_values) 
-            img_temp = img - bkg_mean # create temporary image with bkg removed from each pixel
+        r_out = 2.0*aperture_size
 
-            # perform aperture photometry
-            flux, fluxerr, flag = sep.sum_circle(img_temp, self.source['x'][i], self.source['y'][i], aperture_size,gain=egain,subpix=0)
+        x,y = np.asarray(self.source['x'],dtype=float),np.asarray(self.source['y'],dtype=float)
 
+        # measure the annulus background for every source at once
+        bkg_means = annulusBackground(img,x,y,r_in,r_out,cutoff=self.cutoff)
 
+        # every aperture radius we want, relative to binning (the annulus always stays tied to the main aperture)
+        radii = np.unique([float(r) / float(hdr['XBINNING']) for r in list(self.aperture_sizes)+[self.aperture_size]])
+        main = list(radii).index(aperture_size)
 
-            #####################################################################################################################################################
-            ### perform checks to remove bad data
-            
-            # check for error flags returned in aperture photometry
-                # SExtractor flags:
-                    # 1     The object has neighbors, bright and close enough to 
-                    #       significantly bias the photometry, or bad pixels 
-                    #       (more than 10% of the integrated area affected).
-                    # 2     The object was originally blended with another one.
-                    # 4     At least one pixel of the object is saturated 
-                    #       (or very close to).
-                    # 8     The object is truncates (to close to an image boundary).
-                    # 16    Object's aperture data are incomplete or corrupted.
-                    # 32    Object's isophotal data are incomplete or corrupted.
-                    # 64    A memory overflow occurred during deblending.
-                    # 128   A memory overflow occurred during extraction.
-                    # An object close to an image border may have FLAGS = 16, 
-                    # or perhaps FLAGS = 8+16+32 = 56.
-            if not flag==0:
-                if flag>7:
-                    prnt(self.filename,'SEP flag #%s, star discarded' % str(flag),alert=True)
-                    if verbose_errors:
-                        self.writeError('     in Photometry: Source Extractor flag #%s, star discarded from aperture photometry' % str(flag))
-                    indices_to_remove.append(i)
-                else:
-                    prnt(self.filename,'SEP flag #%s' % str(flag),alert=True)
-                    if verbose_errors:
-                        self.writeError('     in Photometry: Source Extractor flag #%s' % str(flag))
-            
-            # check for negative flux values
-            if flux<0:
-                prnt(self.filename,'Negative flux at pixel position (%s,%s), star discarded' % (self.source['x'][i],self.source['y'][i]),alert=True)
-                if verbose_errors:
-                    self.writeError('     in Photometry: Calculated negative flux at pixel position (%s,%s), star discarded' % (self.source['x'][i],self.source['y'][i]))
-                indices_to_remove.append(i)
+        # perform aperture photometry on every source and every radius in a single call
+        fluxes, fluxerrs, flags = aperturePhotometry(img,x[:,None],y[:,None],radii[None,:],bkg_means[:,None],egain)
+        flux, fluxerr, flag = fluxes[:,main], fluxerrs[:,main], flags[:,main]
 
-            fluxes.append(flux)
-            fluxerrs.append(fluxerr)
 
 
-        ## remove any objects flagged for removal 
-        flux = np.array(fluxes)
-        flux = np.delete(flux, (indices_to_remove), axis=0)
-        objects = np.delete(self.world, (indices_to_remove), axis=0)
+        #####################################################################################################################################################
+        ### perform checks to remove bad data
+
+        # check for error flags returned in aperture photometry
+            # SExtractor flags:
+                # 1     The object has neighbors, bright and close enough to
+                #       significantly bias the photometry, or bad pixels
+                #       (more than 10% of the integrated area affected).
+                # 2     The object was originally blended with another one.
+                # 4     At least one pixel of the object is saturated
+                #       (or very close to).
+                # 8     The object is truncates (to close to an image boundary).
+                # 16    Object's aperture data are incomplete or corrupted.
+                # 32    Object's isophotal data are incomplete or corrupted.
+                # 64    A memory overflow occurred during deblending.
+                # 128   A memory overflow occurred during extraction.
+                # An object close to an image border may have FLAGS = 16,
+                # or perhaps FLAGS = 8+16+32 = 56.
+        flagged = flag>7
+        negative = flux<0 # check for negative flux values
+        keep = ~flagged & ~negative
+
+        # only loop over the bad sources to report them
+        for i in np.nonzero(flag)[0]:
+            if flagged[i]:
+                prnt(self.filename,'SEP flag #%s, star discarded' % str(flag[i]),alert=True)
+                if verbose_errors:
+                    self.writeError('     in Photometry: Source Extractor flag #%s, star discarded from aperture photometry' % str(flag[i]))
+            else:
+                prnt(self.filename,'SEP flag #%s' % str(flag[i]),alert=True)
+                if verbose_errors:
+                    self.writeError('     in Photometry: Source Extractor flag #%s' % str(flag[i]))
+        for i in np.nonzero(negative)[0]:
+            prnt(self.filename,'Negative flux at pixel position (%s,%s), star discarded' % (x[i],y[i]),alert=True)
+            if verbose_errors:
+                self.writeError('     in Photometry: Calculated negative flux at pixel position (%s,%s), star discarded' % (x[i],y[i]))
+
+
+        ## remove any objects flagged for removal
+        flux = flux[keep]
+        fluxerr = fluxerr[keep]
+        objects = np.asarray(self.world)[keep]
 
         # convert flux to instrumental magnitude
-        imags = -2.5*np.log10(flux) 
-        imags_err= 1/np.array(fluxerrs) # includes Poisson noise
+        imags = -2.5*np.log10(flux)
+        imags_err= 1/fluxerr # includes Poisson noise
+
+        # store the multi-aperture measurements and this image's curve-of-growth correction (one row per star per radius)
+        self.apertures = None
+        if len(radii)>1:
+            apcorr = apertureCorrection(fluxes[keep],flags[keep])
+            nstars,nradii = np.shape(fluxes[keep])
+            self.apertures = makeOutput(nstars*nradii,dtype=aperture_dtype)
+            self.apertures['IMGNAME'] = self.filename
+            self.apertures['RA_M'] = np.repeat(objects[:,0],nradii)
+            self.apertures['DEC_M'] = np.repeat(objects[:,1],nradii)
+            self.apertures['RADIUS'] = np.tile(radii*float(hdr['XBINNING']),nstars) # in binning 1x1 pixels like aperture_size
+            self.apertures['FLUX'] = fluxes[keep].ravel()
+            self.apertures['FLUXERR'] = fluxerrs[keep].ravel()
+            self.apertures['FLAG'] = flags[keep].ravel()
+            self.apertures['APCORR'] = np.tile(apcorr,nstars)
+            prnt(self.filename,'Measured %s aperture sizes, curve-of-growth correction %s' % (nradii,np.round(apcorr,3)))
 
         prnt(self.filename, 'Completed aperture photometry, result %s inst. magnitudes' % len(flux))
 
@@ -1033,89 +2999,45 @@ class Field:
 
         #####################################################################################################################################################
         ### query catalog
-        
-        v = Vizier(columns=['UCAC4','+_r','RAJ2000','DEJ2000','Bmag','Vmag','rmag']) # lookup data in the UCAC4 catalog by querying Vizier        
 
         time = hdr['DATE-OBS'] # time image was taken
         time = datetime.strptime(time, '%Y-%m-%dT%H:%M:%S.%f') # convert string to datetime object
         filt = hdr['FILTER'] # filter of image
-        output = OrderedDict([('id',[]),('RA_C',[]),('DEC_C',[]),('RA_M',[]),('DEC_M',[]),('DIF',[]),('MAG_R',[]),('MAG_V',[]),('MAG_B',[]),('MAG_err',[]),('CMAG_R',[]),('CMAG_V',[]),('CMAG_B',[]),('DATETIME',[]),('IMGNAME',[]),('RUNTIME',[])])
-        
-        
-        cmags = [] # catalog magnitudes list we will update in the loop
-        misfires = 0 # number of errors 
-        objects_indices_matched = [] # will store the indices in the objects list of the ones we match to the catalog, so that we only use those stars to calculate offset
+        output = makeOutput(len(objects)) # one row per object, unmatched objects and the other filters' magnitudes stay NaN
 
-        # query each star
-        for n in range(len(objects)): 
-            catalog = 'UCAC4'    
-            
-            # submit query at object coordinates with a radius of 2 arcseconds
-            result = v.query_region(coord.SkyCoord(ra=objects[n,0], dec=objects[n,1],
-            unit=(u.degree, u.degree), frame='fk5'),radius='3s',catalog=catalog) 
-            
-            try:
-                result = result[0] # try to get the first result from the list of results (which is usually just 1 element)
-            except:
-                # prnt(self.filename,'No star match within 3 arcseconds')
-                misfires += 1 
-                # manually fill in the data with mostly nan values 
-                output['id'].append('nan')
-                output['RA_C'].append('nan')
-                output['DEC_C'].append('nan')
-                output['RA_M'].append(objects[n,0])
-                output['DEC_M'].append(objects[n,1])
-                output['DIF'].append('nan')
-                output['DATETIME'].append(time)
-                output['IMGNAME'].append(self.filename)
-                output['RUNTIME'].append(strftime("%Y-%m-%d %H:%M GMT", gmtime()))
-                cmags.append('nan') 
-                continue # skip to the next object by moving to the next iteration of the loop
-
-            fluxtype = filt+'mag' # get a variable for fluxtype to match to catalog magnitude types
-            if filt=='R':
-                fluxtype = 'rmag'
-
-            # get results from query
-            i = np.array(result['UCAC4'],str)[0] # get star id 
-            mag = np.array(result[fluxtype],float)[0] # get catalog mag for specific filter
-            ra = np.array(result['RAJ2000'],float)[0] # get RA from catalog
-            dec = np.array(result['DEJ2000'],float)[0] # get DEC from catalog
-            dif = np.array(result['_r'],float)[0] # difference from target
-
-            # write results if not already written
-            if i not in output['id']:
-                # prnt(self.filename,'Star match in %s, mag %s, residual %s arcsec' % (catalog,mag,dif))
-                output['id'].append(i)
-                output['RA_C'].append(ra)
-                output['DEC_C'].append(dec)
-                output['RA_M'].append(objects[n,0])
-                output['DEC_M'].append(objects[n,1])
-                output['DIF'].append(dif)
-                output['DATETIME'].append(time)
-                output['IMGNAME'].append(self.filename)
-                output['RUNTIME'].append(strftime("%Y-%m-%d %H:%M GMT", gmtime()))
-                cmags.append(mag)
-                if not math.isnan(mag):
-                    objects_indices_matched.append(n)
-            else:
-                # prnt(self.filename,'Star already matched')
-                misfires += 1 
-                # manually fill in the data with mostly nan (not a number) values 
-                output['id'].append('nan')
-                output['RA_C'].append('nan')
-                output['DEC_C'].append('nan')
-                output['RA_M'].append(objects[n,0])
-                output['DEC_M'].append(objects[n,1])
-                output['DIF'].append('nan')
-                output['DATETIME'].append(time)
-                output['IMGNAME'].append(self.filename)
-                output['RUNTIME'].append(strftime("%Y-%m-%d %H:%M GMT", gmtime()))
-                cmags.append('nan') 
-                continue # skip to the next object by moving to the next iteration of the loop
-
-        prnt(self.filename,'Output %s stars' % len(set([v for v in output['id'] if v!='nan'])))
-        prnt(self.filename,'Missed %s objects' % misfires)    
+        fluxtype = filt+'mag' # get a variable for fluxtype to match to catalog magnitude types
+        if filt=='R':
+            fluxtype = 'rmag'
+
+        # submit a single query covering the whole image footprint (plus the match radius)
+        ra_center,dec_center,radius = imageFootprint(hdr)
+        catalog = lookupCatalog(ra_center,dec_center,radius+self.match_radius/3600.)
+        prnt(self.filename,'Retrieved %s catalog stars within %s degrees of the field center' % (len(catalog['UCAC4']),round(radius,3)))
+
+        # match all objects to the catalog at once, if two objects match the same star the closest one wins
+        match,dif = crossMatch(objects[:,0],objects[:,1],catalog['RAJ2000'],catalog['DEJ2000'],self.match_radius)
+        matched = match>=0
+        mag = np.full(len(objects),np.nan)
+        mag[matched] = catalog[fluxtype][match[matched]]
+
+        misfires = int(np.sum(~matched)) # number of objects not matched
+        objects_indices_matched = list(np.nonzero(matched & ~np.isnan(mag))[0]) # indices in the objects list of the ones we match to the catalog, so that we only use those stars to calculate offset
+
+        # unmatched objects keep the nan values they were created with
+        runtime = strftime("%Y-%m-%d %H:%M GMT", gmtime())
+        output['id'][matched] = catalog['UCAC4'][match[matched]]
+        output['RA_C'][matched] = catalog['RAJ2000'][match[matched]]
+        output['DEC_C'][matched] = catalog['DEJ2000'][match[matched]]
+        output['RA_M'] = objects[:,0]
+        output['DEC_M'] = objects[:,1]
+        output['DIF'][matched] = dif[matched]
+        output['DATETIME'] = time.strftime('%Y-%m-%d %H:%M:%S.%f')
+        output['IMGNAME'] = self.filename
+        output['RUNTIME'] = runtime
+        cmags = mag # catalog magnitudes, nan where unmatched
+
+        prnt(self.filename,'Output %s stars' % len(np.unique(output['id'][matched])))
+        prnt(self.filename,'Missed %s objects' % misfires)
 
 
 
@@ -1123,8 +3045,8 @@ class Field:
         ### zero point / offset calculation
 
         # we only want to use these instrumental magnitudes to calculate the offset since we have catalog mags for them
-        imags_cal = [imags[m] for m in objects_indices_matched] 
-        cmags_cal = [m for m in cmags if not math.isnan(float(m))]
+        imags_cal = imags[objects_indices_matched]
+        cmags_cal = cmags[~np.isnan(cmags)]
         
         # check to make sure that we are comparing mags of the same stars
         if not len(imags_cal)==len(cmags_cal): 
@@ -1136,37 +3058,74 @@ class Field:
         prnt(self.filename,'Using %s stars in offset calculation' % len(imags_cal))
         
         # calculate zero point
-        zero_point = np.array(cmags_cal) - np.array(imags_cal) # calculate the differences for each star
-        zero_point_err = np.std(zero_point)/np.sqrt(len(zero_point)) # zero point error is standard error of all differences
-        zero_point = float(np.median(zero_point)) # take the MEDIAN of the difference - median does not consider outliers so a single variable star in the mix won't mess up our constant offset
+        zero_point,zero_point_err = zeroPoint(imags_cal,cmags_cal)
 
         mags = imags+zero_point # update instrumental magnitudes
         mags_err = np.sqrt(imags_err*imags_err+zero_point_err*zero_point_err) # add in quadrature the aperture photometry error and the zero point error
 
         prnt(self.filename,'Completed offset calculation, mean mag for %s stars in field %s' % (len(mags),np.mean(mags)))
         
-        # write calibrated mags to output dict
+        # write calibrated mags to the output table, the other filters' columns stay nan
         output['MAG_err'] = mags_err 
+        if 'MAG_'+filt in output.dtype.names:
+            output['MAG_'+filt] = mags # the intrumental magnitudes + the constant offset
+            output['CMAG_'+filt] = cmags # the catalog magnitudes
 
-        for i in ['R','V','B']: # for each filter
-            magtype = 'MAG_'+i 
-            if i==filt: # if that is the filter the image used
-                output[magtype] = mags # set the output array as the intrumental magnitudes + the constant offset
-            else:
-                output[magtype] = np.full(np.shape(imags),'---',dtype="S3") # otherwise fill with null values
-
-        for i in ['R','V','B']: # same thing
-            magtype = 'CMAG_'+i 
-            if i==filt:
-                output[magtype] = cmags # set the output as the catalog magnitudes
-            else:
-                output[magtype] = np.full(np.shape(cmags),'---',dtype="S3") # otherwise fill with null values
+        if self.save_cutouts: # keep a stamp of every measured star so the photometry can be redone without the full frame
+            self.saveCutouts(x[keep],y[keep],output,cmags)
 
         prnt(self.filename,'Wrote magnitude data to sources.csv') 
         sleep(4)
         return output
 
     
+    def saveCutouts(self,x,y,output,cmags):
+        '''
+        Internal function.
+        Appends a cube of cutouts around each measured star (nan where the cutout runs off the image) and a table of
+        their positions and catalog data to cutout_path/<night>.fits, so rePhotometry() can redo the photometry later.
+        '''
+        hdr,img = self.hdr,self.img
+        R = int(np.ceil(self.cutout_radius/float(hdr['XBINNING'])))
+        size = 2*R+1
+
+        # lower left corner of each cutout, chosen so the star sits in the central pixel
+        x0 = np.trunc(x).astype(int)-R
+        y0 = np.trunc(y).astype(int)-R
+        padded = np.pad(img,R,mode='constant',constant_values=np.nan)
+        offsets = np.arange(size)
+        cube = padded[(y0+R)[:,None,None]+offsets[None,:,None],(x0+R)[:,None,None]+offsets[None,None,:]].astype('<f4')
+
+        stars = np.zeros(len(x),dtype=[('X','<f8'),('Y','<f8'),('X0','<i4'),('Y0','<i4'),('id','S16'),('RA_C','<f8'),('DEC_C','<f8'),
+                                       ('RA_M','<f8'),('DEC_M','<f8'),('DIF','<f8'),('CMAG','<f8')])
+        stars['X'],stars['Y'],stars['X0'],stars['Y0'] = x,y,x0,y0
+        for key in ['id','RA_C','DEC_C','RA_M','DEC_M','DIF']:
+            stars[key] = output[key]
+        stars['CMAG'] = cmags
+
+        h = fits.Header()
+        for key in ['DATE-OBS','FILTER','EGAIN','XBINNING','YBINNING','OBJECT']:
+            if key in hdr:
+                h[key] = hdr[key]
+        h['IMGNAME'] = self.filename
+        h['CUTRAD'] = (R,'cutout half-size in binned pixels')
+
+        # one file per night, named after the date directory the image came from (or its DATE-OBS)
+        night = os.path.basename(os.path.normpath(self.calibrated_path))
+        if not (len(night)==8 and night.isdigit()):
+            night = hdr['DATE-OBS'][0:10].replace('-','')
+        if not os.path.exists(self.cutout_path):
+            os.makedirs(self.cutout_path)
+        name = self.cutout_path+night+'.fits'
+        if not os.path.exists(name):
+            fits.PrimaryHDU().writeto(name)
+        h['EXTNAME'] = 'STAMPS'
+        fits.append(name,cube,h)
+        h['EXTNAME'] = 'STARS'
+        fits.append(name,stars,h)
+        prnt(self.filename,'Saved %s cutouts to %s' % (len(x),name))
+
+
     #####################################################################################################################################################
     ### plot images with an ellipse around each detected star (rarely used)
     #####################################################################################################################################################
@@ -1206,21 +3165,95 @@ class Field:
 
 
     def writeData(self):
-        with open('sources.csv', 'a') as outfile:
-            writer = csv.writer(outfile)
-            if self.columnsWritten==False:
-                writer.writerow(self.output.keys())
-                self.columnsWritten = True
-            writer.writerows(zip(*self.output.values()))
-        
-   
+        writeTable('sources.csv',self.output,header=not (self.columnsWritten and os.path.exists('sources.csv')))
+        self.columnsWritten = True
+
+        # extra aperture sizes go in their own file so sources.csv keeps the same columns
+        if self.apertures is not None:
+            writeTable('apertures.csv',self.apertures)
+
+
     def Extract(self):
-        self.source = self.Source()
+        self.source = None
+        if self.forced: # use the field's reference positions if we have them
+            self.source = self.Forced()
+        detected = self.source is None
+        # don't spend time on clouded, trailed or defocused frames (with forced photometry, only check the sky, since
+        # counting stars would cost the source detection we are skipping)
+        if self.quality_check and not self.Quality(count_stars=detected):
+            return
+        if detected and self.use_src: # then the Image Link source list
+            self.source = self.readSRC()
+        if self.source is None: # otherwise detect sources ourselves
+            self.source = self.Source()
         self.world = self.Convert()
+        if self.world=='NOWCS' and self.plate_solve and self.Solve(): # recover frames Image Link couldn't solve
+            self.world = self.Convert()
         if self.world =='NOWCS':
             prnt(self.filename,'No WCS data exists in the header for this image, skipping...',alert = True)
             self.writeError('     No WCS data found in image header, image skipped')
             sleep(2)
         else:
+            if self.forced and detected:
+                self.updateReference()
             self.output = self.Photometry()
-            self.writeData()
\ No newline at end of file
+            self.writeData()
+
+
+    def Stack(self,filenames):
+        '''
+        Co-adds calibrated frames from calibrated_path that share a field, filter and binning and were taken within
+        stack_window minutes of the first frame of the stack, and runs Extract() once per stack instead of once per frame.
+        Stacks are written to stack_path/<date>/. Frames without WCS, or in groups smaller than stack_min_frames, are
+        extracted on their own as usual.
+        '''
+        header('Stacking')
+        flushWrites() # the frames are read back from disk
+        groups = OrderedDict()
+        single = []
+        for filename in filenames:
+            h = imageHeader(self.calibrated_path+filename.replace('.fits','_c.fits'))
+            if 'WCSVER' not in h:
+                single.append(filename)
+                continue
+            key = (self.fieldName(h,filename),h['FILTER'],h['XBINNING'])
+            groups.setdefault(key,[]).append((datetime.strptime(h['DATE-OBS'],'%Y-%m-%dT%H:%M:%S.%f'),filename))
+
+        # split each group into time bins that start at their first frame
+        stacks = []
+        for key in groups:
+            frames = sorted(groups[key])
+            start,current = None,[]
+            for time,filename in frames:
+                if start is None or (time-start).total_seconds()>60.0*self.stack_window:
+                    if current:
+                        stacks.append((key,current))
+                    start,current = time,[]
+                current.append(filename)
+            stacks.append((key,current))
+
+        date = os.path.basename(os.path.normpath(self.calibrated_path))
+        stack_path = self.stack_path+date+'/'
+        if not os.path.exists(stack_path):
+            os.makedirs(stack_path)
+
+        calibrated_path = self.calibrated_path
+        for (field,filt,binning),frames in stacks:
+            if len(frames)<self.stack_min_frames:
+                single += frames
+                continue
+            h,stack = stackFrames([calibrated_path+f.replace('.fits','_c.fits') for f in frames])
+            name = '%s_%s_%s_stack.fits' % (field,filt,h['DATE-OBS'][11:19].replace(':',''))
+            writeImage(stack_path+name.replace('.fits','_c.fits'),stack,h,overwrite=True)
+            print('Stacked %s %s frames of %s into %s' % (len(frames),filt,field,name))
+
+            self.calibrated_path = stack_path # photometry on the stack
+            try:
+                self.openFits(name,calibrated=True,inPipeline=True)
+                self.Extract()
+            finally:
+                self.calibrated_path = calibrated_path
+
+        for filename in sorted(single):
+            self.openFits(filename,calibrated=True,inPipeline=True)
+            self.Extract()
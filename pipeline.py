@@ -16,6 +16,13 @@ try:
     # obs.slow = True #(default false)
     #obs.days_old = 2 #(default 1)
     # obs.verbose_errors = True #(default False, uncomment if haing difficulties in automated pipeline run)
+    # obs.catalog_cache = False #(default True, keeps UCAC4 queries on disk by sky tile in obs.catalog_cache_path)
+    # obs.catalog_cache_size = 1000.0 #(default 500.0 MB, least recently used tiles are deleted past this)
+    # obs.assign_source_ids = True #(default False, needs scipy, gives every detection a persistent source id in source_ids.csv)
+    # obs.catalog_backend = 'local' #(default 'vizier', 'local' reads a catalog made with obs.ingestCatalog(...) so no network is needed)
+    # obs.image_compression = 'RICE_1' #(default None for plain float32, or 'GZIP_2', tile compresses calibrated images, stacks and masters)
+    # obs.quantize_level = 32.0 #(default 16.0, larger keeps more precision, 0 with 'GZIP_2' is lossless)
+    # obs.buildQuadIndex(scale=(0.05,0.25)) # (run once after ingesting a local catalog) lets f.Solve() plate solve images Image Link couldn't
 
     obs.dailyCopy(writeOver=False) 
     # change writeOver to True if you want to overwrite files on the Linux box with updates ones on the Dome computer
@@ -30,29 +37,56 @@ try:
     f.uncalibrated_path = 'ArchSky/'
     f.calibrated_path = 'ReducedImages/'
     f.aperture_size = 30 #(default 30)
+    # f.aperture_sizes = [10,15,20,25,40] #(default [], extra aperture sizes measured in the same pass and saved to apertures.csv)
     # f.cutoff = False #(default True)
+    # f.save_cutouts = True #(default False, saves a cutout of every measured star to f.cutout_path so obs.rePhotometry('Cutouts/*.fits',aperture_size=...) can redo the photometry)
+    # f.cache_products = False #(default True, reuse detections and world coordinates saved next to the calibrated image when it hasn't changed)
+    # f.use_src = True #(default False, use Image Link's .SRC source lists instead of sep, check f.src_columns and f.src_origin with benchmark.py src first)
+    # f.tiles = (2,2) #(default (1,1), split frames into tiles for source detection run on f.threads threads)
+    # f.detect_binning = 2 #(default 1, detect on a 2x2 or 4x4 binned copy, check with f.Completeness() first)
+    # f.forced = True #(default False, measure each field at its saved reference positions and only detect every f.detect_cadence images; sources join the reference list once two detection passes find them)
     # f.max_temp = -2.0 #(default -3.0)
+    # f.nearest_masters = False #(default True, use the masters closest in time to each image from MasterCal/ and MasterCal/archive/, see obs.master_temp_tolerance and obs.master_cache_size)
+    # f.calibration_rows = None #(default 256, rows calibrated at a time in place, None for the whole frame at once)
+    # f.write_behind = False #(default True, write calibrated images in a background thread, at most obs.write_queue_size waiting)
+    # f.plate_solve = False #(default True, plate solve images without WCS if there is a quad index, within f.solve_radius degrees of the header pointing)
+    # f.stack = True #(default False, co-add frames of the same field and filter taken within f.stack_window minutes and run photometry once per stack)
+    # f.quality_check = True #(default False, skip photometry for frames with too few stars or bad FWHM/elongation, see f.min_stars, f.max_fwhm, f.max_elongation, f.max_sky)
 
     for j in range(obs.days_old):
         i = 1
         if f.Initialize(j):
+            stack_list = []
             for filename in f.list_of_files:
                 f.counter = i
                 i += 1
-                f.openFits(filename,calibrated=False,inPipeline=True)
+                f.openFits(filename,calibrated=False,inPipeline=True,header_only=True) # pixels are only read if Reduce needs them
                 f.Reduce(inPipeline=True)
                 if f.isCalibrated and f.narrowBand:
-                    f.openFits(filename,calibrated=True,inPipeline=True)
-                    f.Extract()
+                    if f.stack:
+                        stack_list.append(filename) # measured as part of a stack below
+                    else:
+                        f.Extract() # straight from the calibrated image Reduce left in memory
+            if f.stack:
+                f.Stack(stack_list)
+            obs.flushWrites() # wait for the last calibrated images to be written
+
+    if obs.assign_source_ids:
+        try:
+            obs.assignSourceIDs() # give tonight's detections persistent source ids (appends to source_ids.csv)
+        except Exception:
+            obs.writeError('     in assignSourceIDs: '+traceback.format_exc()) # an optional stage, don't lose the rest of the run over it
 
 except KeyboardInterrupt:
     raise
 except:
     tb = traceback.format_exc()
+    obs.flushWrites()
     obs.writeError(tb)
     obs.sendError(tb)
     raise 
 
+obs.clearMasters() # release the master frames kept in memory during the run
 obs.writeError('Completed daily run...')
 obs.end_time = strftime("%Y-%m-%d %H:%M GMT", gmtime())
 obs.sendStatus()